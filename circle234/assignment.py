@@ -0,0 +1,150 @@
+import numpy as np
+
+from robot import FORMATION_SLOTS
+
+
+def linear_assignment(cost):
+    """
+    Hungarian algorithm (shortest augmenting paths with potentials), O(n^2 m).
+    cost is an (n, m) array with n <= m, returns the column assigned to each row
+    such that the total cost is minimal.
+    """
+    cost = np.asarray(cost, dtype=np.float64)
+    n, m = cost.shape
+    if n > m:
+        raise ValueError("more rows than columns (%d > %d)" % (n, m))
+    # 1-based, column 0 is a virtual column holding the row being inserted
+    u = np.zeros(n + 1)
+    v = np.zeros(m + 1)
+    row_of = np.zeros(m + 1, dtype=np.int64)
+    way = np.zeros(m + 1, dtype=np.int64)
+    for i in range(1, n + 1):
+        row_of[0] = i
+        j0 = 0
+        minv = np.full(m + 1, np.inf)
+        used = np.zeros(m + 1, dtype=bool)
+        while True:
+            used[j0] = True
+            i0 = row_of[j0]
+            free = ~used[1:]
+            reduced = cost[i0 - 1] - u[i0] - v[1:]
+            better = free & (reduced < minv[1:])
+            minv[1:][better] = reduced[better]
+            way[1:][better] = j0
+            candidates = np.where(free, minv[1:], np.inf)
+            j1 = int(candidates.argmin()) + 1
+            delta = candidates[j1 - 1]
+            u[row_of[used]] += delta
+            v[used] -= delta
+            minv[1:][free] -= delta
+            j0 = j1
+            if row_of[j0] == 0:
+                break
+        # augment along the path
+        while j0:
+            j1 = way[j0]
+            row_of[j0] = row_of[j1]
+            j0 = j1
+
+    assignment = np.empty(n, dtype=np.int64)
+    for j in range(1, m + 1):
+        if row_of[j]:
+            assignment[row_of[j] - 1] = j - 1
+    return assignment
+
+
+def _has_matching(allowed):
+    """
+    Whether every row of the boolean (n, m) array can be matched to a distinct allowed column.
+    Hopcroft-Karp, with iterative searches so that the depth of the augmenting paths is not
+    limited by the recursion limit.
+    """
+    n, m = allowed.shape
+    if n > m:
+        return False
+    adjacency = [np.flatnonzero(row).tolist() for row in allowed]
+    column_of = [-1] * n
+    row_of = [-1] * m
+    matched = 0
+    while True:
+        # breadth first search from the free rows: layer of each row along alternating paths
+        layer = [-1] * n
+        queue = [i for i in range(n) if column_of[i] < 0]
+        for i in queue:
+            layer[i] = 0
+        reachable = False
+        for i in queue:
+            for j in adjacency[i]:
+                k = row_of[j]
+                if k < 0:
+                    reachable = True
+                elif layer[k] < 0:
+                    layer[k] = layer[i] + 1
+                    queue.append(k)
+        if not reachable:
+            return matched == n
+
+        # depth first searches along the layers, each row is a dead end once all its columns are tried
+        next_edge = [0] * n
+        for root in range(n):
+            if column_of[root] >= 0:
+                continue
+            rows = [root]
+            columns = []
+            while rows:
+                i = rows[-1]
+                if next_edge[i] == len(adjacency[i]):
+                    layer[i] = -1
+                    rows.pop()
+                    if columns:
+                        columns.pop()
+                    continue
+                j = adjacency[i][next_edge[i]]
+                next_edge[i] += 1
+                k = row_of[j]
+                if k < 0:
+                    columns.append(j)
+                    for i, j in zip(rows, columns):
+                        column_of[i] = j
+                        row_of[j] = i
+                    matched += 1
+                    break
+                if layer[k] == layer[i] + 1:
+                    rows.append(k)
+                    columns.append(j)
+
+
+def bottleneck_assignment(cost):
+    """
+    Returns the column assigned to each row such that the largest cost is minimal,
+    ties being broken by the smallest total cost
+    """
+    cost = np.asarray(cost, dtype=np.float64)
+    values = np.unique(cost)
+    low, high = 0, len(values) - 1
+    while low < high:
+        mid = (low + high) // 2
+        if _has_matching(cost <= values[mid]):
+            high = mid
+        else:
+            low = mid + 1
+    # forbid the costs above the bottleneck with a cost larger than any assignment
+    penalty = cost.sum() + 1.
+    return linear_assignment(np.where(cost <= values[low], cost, penalty))
+
+
+def formation_roles(positions, formation, objective="sum"):
+    """
+    Assigns the robots to the slots of formation, placed on the centroid of the robots.
+    positions is an (n, 2) array, objective is "sum" to minimize the total travel distance or
+    "bottleneck" to minimize the longest one. Returns the slot of each robot.
+    """
+    slots = FORMATION_SLOTS[formation] if isinstance(formation, str) else np.asarray(formation)
+    positions = np.asarray(positions)[:, :2]
+    targets = slots - slots.mean(axis=0) + positions.mean(axis=0)
+    cost = np.sqrt(((positions[:, None, :] - targets[None, :, :]) ** 2).sum(axis=-1))
+    if objective == "sum":
+        return linear_assignment(cost)
+    elif objective == "bottleneck":
+        return bottleneck_assignment(cost)
+    raise ValueError("unknown assignment objective %s" % objective)
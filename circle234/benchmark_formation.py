@@ -0,0 +1,143 @@
+# Time-to-formation benchmark: simulated and wall time needed by the swarm to reach
+# each formation from the standard start poses, for every controller mode.
+#
+#   python benchmark_formation.py
+#   python benchmark_formation.py --formations circle2 diamond --modes consensus scheduled
+#   python benchmark_formation.py --mission
+#   python benchmark_formation.py --assignment bottleneck
+import argparse
+import time
+
+from robot import Robot, FORMATION_SLOTS, formation_error
+from swarm_simulation import World
+
+FORMATIONS = ["square", "line", "circle1", "circle2", "diamond"]
+MODES = ["consensus", "scheduled", "turn_drive"]
+
+
+class FormationRobot(Robot):
+    """
+    Robot that only holds one formation (the class attribute formation) with the consensus law
+    """
+    __slots__ = ()
+    formation = "square"
+    gain = 5.
+
+    @classmethod
+    def formation_for(cls, state):
+        return cls.formation
+
+    def compute_controller(self):
+        neig = self.get_neighbors()
+        messages = self.get_messages()
+        pos, rot = self.get_pos_and_orientation()
+
+        for n in neig:
+            self.send_message(n, [pos, self.state])
+
+        slots = FORMATION_SLOTS[self.formation]
+        dx = 0.
+        dy = 0.
+        if messages:
+            for m in messages:
+                offset = slots[self.role(self.id)] - slots[self.role(m[0])]
+                dx += m[1][0][0] - pos[0] + offset[0]
+                dy += m[1][0][1] - pos[1] + offset[1]
+            self.drive(dx, dy, rot, self.gain)
+
+
+def configured(robot_class, **attributes):
+    """
+    Returns a subclass of robot_class with the given class attributes, so that a run
+    leaves the classes used by the other runs unchanged
+    """
+    attributes["__slots__"] = ()
+    return type(robot_class.__name__, (robot_class,), attributes)
+
+
+def swarm_formation_error(world, formation):
+    """
+    Largest distance between a robot and its slot, once both are centered on their centroid
+    """
+    return formation_error(world.swarm.pos[:, :2], formation, world.swarm.role)
+
+
+def time_to_formation(formation, mode, tolerance=0.05, max_time=60., check_every=25, assignment=None):
+    """
+    Returns (simulated time, wall time) to reach the formation, simulated time is None if it was not reached
+    """
+    robot_class = configured(FormationRobot, formation=formation, controller_mode=mode)
+    world = World(gui=False, robot_class=robot_class, assignment=assignment)
+    reached = None
+    steps = 0
+    start = time.time()
+    while world.time < max_time:
+        world.stepSimulation()
+        steps += 1
+        if steps % check_every == 0 and swarm_formation_error(world, formation) < tolerance:
+            reached = world.time
+            break
+    wall = time.time() - start
+    world.close()
+    return reached, wall
+
+
+def mission_phase_times(mode, max_time=300., assignment=None):
+    """
+    Runs the full mission and returns, for each phase, the simulated time at which all robots had
+    left it (i.e. entered the next one, or the mission was complete). Phases not over are left out.
+    """
+    world = World(gui=False, robot_class=configured(Robot, controller_mode=mode), assignment=assignment)
+    entered = {}
+    while world.time < max_time:
+        world.stepSimulation()
+        phase = min(r.state for r in world.robots)
+        if phase not in entered:
+            entered[phase] = world.time
+        if world.mission_complete:
+            break
+    end = world.time if world.mission_complete else None
+    world.close()
+    phases = sorted(entered)
+    ends = [entered[phase] for phase in phases[1:]] + [end]
+    return dict((phase, t) for phase, t in zip(phases, ends) if t is not None)
+
+
+def _format(value):
+    return "   -   " if value is None else "%7.2f" % value
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="time-to-formation benchmark")
+    parser.add_argument("--formations", nargs="+", default=FORMATIONS, choices=FORMATIONS)
+    parser.add_argument("--modes", nargs="+", default=MODES, choices=MODES)
+    parser.add_argument("--tolerance", type=float, default=0.05, help="formation error (m) counted as reached")
+    parser.add_argument("--max-time", type=float, default=60., help="simulated seconds before giving up")
+    parser.add_argument("--mission", action="store_true", help="time the phases of the full mission instead")
+    parser.add_argument("--assignment", choices=["sum", "bottleneck"], default=None,
+                        help="assign the robots to the formation slots (default: robot i holds slot i)")
+    args = parser.parse_args()
+
+    if args.mission:
+        # simulated time at which each phase is over, and how much sooner than with the first mode
+        results = dict((mode, mission_phase_times(mode, args.max_time, args.assignment)) for mode in args.modes)
+        phases = sorted(set().union(*results.values()))
+        print("%-11s %5s %8s %10s %8s" % ("mode", "phase", "end [s]", "sooner [s]", "speed-up"))
+        for mode in args.modes:
+            for phase in phases:
+                baseline = results[args.modes[0]].get(phase)
+                done = results[mode].get(phase)
+                sooner = baseline - done if baseline is not None and done is not None else None
+                speedup = baseline / done if baseline and done else None
+                print("%-11s %5d  %s    %s  %s" % (mode, phase, _format(done), _format(sooner), _format(speedup)))
+    else:
+        print("%-9s %-11s %8s %8s %8s" % ("formation", "mode", "sim [s]", "wall [s]", "speed-up"))
+        for formation in args.formations:
+            baseline = None
+            for mode in args.modes:
+                reached, wall = time_to_formation(formation, mode, args.tolerance, args.max_time,
+                                                  assignment=args.assignment)
+                if mode == args.modes[0]:
+                    baseline = reached
+                speedup = baseline / reached if baseline and reached else None
+                print("%-9s %-11s %s %8.2f %s" % (formation, mode, _format(reached), wall, _format(speedup)))
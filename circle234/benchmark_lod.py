@@ -0,0 +1,61 @@
+# Scaling benchmark of the robot fidelity levels: physics throughput of swarms of growing size
+# made of full robots (robot.sdf with wheel joints) or simple ones (single body driven by its
+# base velocity), all driving in circles on the plane of the arena.
+#
+#   python benchmark_lod.py
+#   python benchmark_lod.py --sizes 10 100 400 --steps 500
+import argparse
+import time
+
+import numpy as np
+import pybullet as p
+
+from robot import Robot, forget_shapes
+from swarm_simulation import load_static_scene
+from swarm_state import SwarmState
+
+
+def steps_per_second(n_robots, fidelity, steps, spacing=0.6):
+    """
+    Simulates n_robots of the given fidelity for steps steps, returns the simulation steps per wall second
+    """
+    client = p.connect(p.DIRECT)
+    p.setGravity(0, 0, -9.81, physicsClientId=client)
+    dt = 1. / 250.
+    p.setPhysicsEngineParameter(dt, numSubSteps=1, physicsClientId=client)
+    load_static_scene(client)
+
+    # a square grid of robots away from the walls
+    side = int(np.ceil(np.sqrt(n_robots)))
+    swarm = SwarmState(n_robots)
+    robots = []
+    for i in range(n_robots):
+        init_pos = [-3. - spacing * (i % side), spacing * (i // side), 0.3]
+        robots.append(Robot(init_pos, i, dt, swarm, fidelity=fidelity, client=client))
+    for r in robots:
+        r.set_wheel_velocity([4., 5.])
+
+    start = time.time()
+    for _ in range(steps):
+        for r in robots:
+            r.apply_wheel_velocity()
+        p.stepSimulation(physicsClientId=client)
+        for r in robots:
+            r.update_pose()
+    elapsed = time.time() - start
+    p.disconnect(client)
+    forget_shapes(client)
+    return steps / elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="throughput of the robot fidelity levels")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[6, 24, 96, 384])
+    parser.add_argument("--steps", type=int, default=1000)
+    args = parser.parse_args()
+
+    print("%7s %12s %13s %8s" % ("robots", "full [st/s]", "simple [st/s]", "ratio"))
+    for n in args.sizes:
+        full = steps_per_second(n, "full", args.steps)
+        simple = steps_per_second(n, "simple", args.steps)
+        print("%7d %12.1f %13.1f %8.2f" % (n, full, simple, simple / full))
@@ -0,0 +1,43 @@
+# Compares the mission run with several deadbands of the wheel commands (World(command_deadband=...)):
+# motor commands sent to pybullet and skipped, wall time, and how far the robots end up from
+# the run where every changed command is sent (deadband 0).
+#
+#   python compare_command_deadband.py --time 120
+#   python compare_command_deadband.py --deadbands 0 0.01 0.1 0.5
+import argparse
+
+from compare_time_stepping import deviation, sample_run
+from swarm_simulation import World
+
+
+def run(sim_time, sample_period, deadband):
+    """
+    Simulates the mission for sim_time seconds with the given deadband, returns the world
+    statistics and the positions of the robots every sample_period seconds
+    """
+    world = World(gui=False, command_deadband=deadband)
+    wall, samples = sample_run(world, sim_time, sample_period)
+    stats = dict(world.command_counts)
+    stats["wall"] = wall
+    stats["states"] = [r.state for r in world.robots]
+    world.close()
+    return stats, samples
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="wheel command deadbands")
+    parser.add_argument("--time", type=float, default=60., help="simulated seconds")
+    parser.add_argument("--sample", type=float, default=0.1, help="seconds between two compared positions")
+    parser.add_argument("--deadbands", type=float, nargs="+", default=[0., 0.01, 0.1], help="rad/s")
+    args = parser.parse_args()
+
+    reference = None
+    print("%9s %8s %8s %8s %8s %10s %10s" % ("deadband", "sent", "skipped", "skipped", "wall [s]", "states", "max diff"))
+    for deadband in args.deadbands:
+        stats, samples = run(args.time, args.sample, deadband)
+        if reference is None:
+            reference = samples
+        total = max(stats["sent"] + stats["skipped"], 1)
+        print("%9g %8d %8d %7.0f%% %8.2f %10s %8.3f m"
+              % (deadband, stats["sent"], stats["skipped"], 100. * stats["skipped"] / total, stats["wall"],
+                 "".join(map(str, stats["states"])), deviation(reference, samples).max()))
@@ -0,0 +1,76 @@
+# Compares the mission run with the fixed 250Hz time step and with adaptive time stepping
+# (World(adaptive_step=True)): physics steps and wall time spent, and how far the robots
+# end up from their fixed-step trajectory.
+#
+#   python compare_time_stepping.py --time 120
+#   python compare_time_stepping.py --coarse-factor 8 --margin 0.3
+import argparse
+import time
+
+import numpy as np
+
+from swarm_simulation import World
+
+
+def sample_run(world, sim_time, sample_period):
+    """
+    Simulates the mission in world for sim_time seconds, returns the wall time spent and the
+    positions of the robots every sample_period seconds
+    """
+    samples = []
+    next_sample = 0.
+    start = time.time()
+    while world.time < sim_time:
+        world.stepSimulation()
+        if world.time >= next_sample:
+            samples.append(world.swarm.pos[:, :2].copy())
+            next_sample += sample_period
+    return time.time() - start, np.array(samples)
+
+
+def deviation(reference, samples):
+    """
+    Returns the distance of every robot to its reference position, per common sample
+    """
+    n = min(len(reference), len(samples))
+    return np.sqrt(((reference[:n] - samples[:n]) ** 2).sum(axis=-1))
+
+
+def run(sim_time, sample_period, adaptive, coarse_factor=4, margin=0.5):
+    """
+    Simulates the mission for sim_time seconds, returns the world statistics and the
+    positions of the robots every sample_period seconds
+    """
+    world = World(gui=False, adaptive_step=adaptive)
+    world.coarse_factor = coarse_factor
+    world.contact_margin = margin
+    wall, samples = sample_run(world, sim_time, sample_period)
+    stats = {"steps": sum(world.step_counts.values()),
+             "coarse_steps": world.step_counts["coarse"],
+             "steps_saved": world.steps_saved,
+             "wall": wall,
+             "states": [r.state for r in world.robots]}
+    world.close()
+    return stats, samples
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="fixed versus adaptive time stepping")
+    parser.add_argument("--time", type=float, default=60., help="simulated seconds")
+    parser.add_argument("--sample", type=float, default=0.1, help="seconds between two compared positions")
+    parser.add_argument("--coarse-factor", type=int, default=4)
+    parser.add_argument("--margin", type=float, default=0.5, help="distance to walls and balls that forces fine steps")
+    args = parser.parse_args()
+
+    fixed, fixed_samples = run(args.time, args.sample, False)
+    adaptive, adaptive_samples = run(args.time, args.sample, True, args.coarse_factor, args.margin)
+
+    difference = deviation(fixed_samples, adaptive_samples)
+    print("%-10s %8s %8s %10s" % ("", "steps", "wall [s]", "states"))
+    for name, stats in (("fixed", fixed), ("adaptive", adaptive)):
+        print("%-10s %8d %8.2f %10s" % (name, stats["steps"], stats["wall"], "".join(map(str, stats["states"]))))
+    print("coarse steps: %d, physics steps saved: %d (%.0f%%)"
+          % (adaptive["coarse_steps"], adaptive["steps_saved"],
+             100. * adaptive["steps_saved"] / max(fixed["steps"], 1)))
+    print("position difference to the fixed step run: mean %.3f m, max %.3f m, final %.3f m"
+          % (difference.mean(), difference.max(), difference[-1].max()))
@@ -0,0 +1,219 @@
+# Headless control server: external controllers (optimizers, learned policies, ...) drive the
+# swarm over a local UNIX socket. Each connection is a session with its own World, simulated in
+# its own forked process, in which the built-in controllers are disabled. A request applies
+# wheel commands for the next k steps and returns the stacked poses, mission states and events
+# of these steps, so a round trip is paid once per k steps.
+#
+#   python control_server.py --socket /tmp/swarm.sock
+#
+#   client = ControlClient("/tmp/swarm.sock")
+#   result = client.step(np.zeros((client.n_robots, 2)), k=50)
+#
+# Protocol: every message is a frame made of a 4 byte opcode, the payload length (uint32,
+# little endian) and the payload. Arrays are sent as raw little endian float64 / int64.
+#   INFO -> INFO [n_robots, n_balls (uint32), dt (float64)]
+#   STEP [k (uint32), wheels (n_robots, 2) or (k, n_robots, 2) float64]
+#        -> DATA [k, n_robots, n_balls, mission complete, events length (uint32),
+#                 time (k), poses (k, n_robots, 3) as x, y, yaw, states (k, n_robots) int64,
+#                 balls (k, n_balls, 2), events as json]
+#   RSET -> RSET (start a new episode)
+#   QUIT -> QUIT (ends the session)
+# A request that fails is answered by EROR with the error message as payload.
+import argparse
+import json
+import os
+import socket
+import socketserver
+import stat
+import struct
+
+import numpy as np
+import pybullet as p
+
+FRAME = struct.Struct("<4sI")
+INFO = struct.Struct("<IId")
+STEP = struct.Struct("<I")
+DATA = struct.Struct("<IIIII")
+
+
+def send_frame(sock, opcode, payload=b""):
+    sock.sendall(FRAME.pack(opcode, len(payload)) + payload)
+
+
+def _receive_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise EOFError("connection closed")
+        data += chunk
+    return bytes(data)
+
+
+def receive_frame(sock):
+    opcode, size = FRAME.unpack(_receive_exactly(sock, FRAME.size))
+    return opcode, _receive_exactly(sock, size)
+
+
+class Session():
+    """
+    A World driven by one client
+    """
+    def __init__(self, world_options):
+        # imported here so that only the session processes connect to pybullet
+        from swarm_simulation import World
+        self.world = World(gui=False, run_controllers=False, **world_options)
+
+    def info(self):
+        world = self.world
+        return INFO.pack(len(world.robots), len(world.balls), world.dt)
+
+    def step(self, payload):
+        world = self.world
+        n = len(world.robots)
+        n_balls = len(world.balls)
+        k, = STEP.unpack_from(payload)
+        wheels = np.frombuffer(payload, dtype="<f8", offset=STEP.size)
+        # the same commands for all the steps are sent once, the motors hold them
+        held = wheels.size == n * 2
+        if held:
+            wheels = wheels.reshape(1, n, 2)
+        elif wheels.size == k * n * 2:
+            wheels = wheels.reshape(k, n, 2)
+        else:
+            raise ValueError("expected %d or %d wheel velocities, got %d" % (n * 2, k * n * 2, wheels.size))
+
+        times = np.empty(k)
+        poses = np.empty((k, n, 3))
+        states = np.empty((k, n), dtype="<i8")
+        balls = np.empty((k, n_balls, 2))
+        events = []
+        world.events.poll()
+        for step in range(k):
+            if not held or step == 0:
+                for r, command in zip(world.robots, wheels[0 if held else step]):
+                    r.set_wheel_velocity(command)
+            world.stepSimulation()
+            times[step] = world.time
+            poses[step, :, :2] = world.swarm.pos[:, :2]
+            poses[step, :, 2] = world.swarm.yaw
+            states[step] = world.swarm.mission_state
+            for b, ball in enumerate(world.balls):
+                balls[step, b] = p.getBasePositionAndOrientation(ball, physicsClientId=world.physicsClient)[0][:2]
+            events += [[step] + list(e) for e in world.events.poll()]
+
+        encoded = json.dumps(events).encode()
+        header = DATA.pack(k, n, n_balls, int(world.mission_complete), len(encoded))
+        return b"".join([header, times.astype("<f8").tobytes(), poses.astype("<f8").tobytes(),
+                         states.tobytes(), balls.astype("<f8").tobytes(), encoded])
+
+    def reset(self):
+        self.world.reset()
+
+    def close(self):
+        self.world.close()
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        session = Session(self.server.world_options)
+        try:
+            while True:
+                try:
+                    opcode, payload = receive_frame(self.request)
+                except EOFError:
+                    break
+                try:
+                    if opcode == b"INFO":
+                        send_frame(self.request, b"INFO", session.info())
+                    elif opcode == b"STEP":
+                        send_frame(self.request, b"DATA", session.step(payload))
+                    elif opcode == b"RSET":
+                        session.reset()
+                        send_frame(self.request, b"RSET")
+                    elif opcode == b"QUIT":
+                        send_frame(self.request, b"QUIT")
+                        break
+                    else:
+                        raise ValueError("unknown opcode %r" % opcode)
+                except Exception as e:
+                    send_frame(self.request, b"EROR", str(e).encode())
+        finally:
+            session.close()
+
+
+class ControlServer(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+    """
+    Serves sessions on the UNIX socket path, each in a forked process with its own World
+    built with world_options (e.g. {"fidelity": "simple"})
+    """
+    def __init__(self, path, world_options=None):
+        # a socket left by a previous server is replaced, any other file is kept
+        if os.path.lexists(path):
+            if not stat.S_ISSOCK(os.lstat(path).st_mode):
+                raise ValueError("%s exists and is not a socket" % path)
+            os.remove(path)
+        self.world_options = world_options or {}
+        socketserver.UnixStreamServer.__init__(self, path, _Handler)
+
+
+class ControlClient():
+    """
+    Client side of a session of a ControlServer
+    """
+    def __init__(self, path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.n_robots, self.n_balls, self.dt = INFO.unpack(self._request(b"INFO", expected=b"INFO"))
+
+    def _request(self, opcode, payload=b"", expected=None):
+        send_frame(self.sock, opcode, payload)
+        reply, data = receive_frame(self.sock)
+        if reply == b"EROR":
+            raise RuntimeError(data.decode())
+        if reply != (expected or opcode):
+            raise RuntimeError("unexpected reply %r" % reply)
+        return data
+
+    def step(self, wheels, k=1):
+        """
+        Applies wheels (n_robots, 2), held for k steps, or (k, n_robots, 2), one per step.
+        Returns a dict with the time (k), poses (k, n_robots, 3) as x, y, yaw, states (k, n_robots),
+        balls (k, n_balls, 2), events (list of [step, time, kind, subject, region]) and complete.
+        """
+        wheels = np.ascontiguousarray(wheels, dtype="<f8")
+        data = self._request(b"STEP", STEP.pack(k) + wheels.tobytes(), expected=b"DATA")
+        k, n, n_balls, complete, events_size = DATA.unpack_from(data)
+        offset = DATA.size
+        result = {"complete": bool(complete)}
+        for name, dtype, shape in (("time", "<f8", (k,)), ("poses", "<f8", (k, n, 3)),
+                                   ("states", "<i8", (k, n)), ("balls", "<f8", (k, n_balls, 2))):
+            count = int(np.prod(shape))
+            result[name] = np.frombuffer(data, dtype=dtype, count=count, offset=offset).reshape(shape)
+            offset += count * 8
+        result["events"] = json.loads(data[offset:offset + events_size].decode())
+        return result
+
+    def reset(self):
+        self._request(b"RSET")
+
+    def close(self):
+        try:
+            self._request(b"QUIT")
+        finally:
+            self.sock.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="headless control server for external controllers")
+    parser.add_argument("--socket", default="/tmp/swarm_control.sock")
+    parser.add_argument("--fidelity", default="full", choices=["full", "simple", "auto"])
+    parser.add_argument("--adaptive-step", action="store_true")
+    args = parser.parse_args()
+
+    server = ControlServer(args.socket, {"fidelity": args.fidelity, "adaptive_step": args.adaptive_step})
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(args.socket)
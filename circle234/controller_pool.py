@@ -0,0 +1,205 @@
+import multiprocessing
+import threading
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from robot import controller_parameters
+from shared_mailbox import SharedMailbox
+from swarm_state import SwarmState
+
+
+class _SharedState():
+    """
+    Shared memory block laid out as: a SwarmState of the inputs of the controllers (poses,
+    neighbors, range readings, mission states), a SwarmState of their outputs (wheel commands, mission states),
+    the current tick (negative while the inputs are being written), a stop flag, and for every
+    robot the last tick for which its outputs are ready.
+    """
+    def __init__(self, n_robots, name=None, n_rays=0):
+        state_bytes = SwarmState.nbytes(n_robots, n_rays)
+        size = 2 * state_bytes + 8 * (n_robots + 2)
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.created = name is None
+        self.inputs = SwarmState(n_robots, self.shm.buf[:state_bytes], n_rays)
+        self.outputs = SwarmState(n_robots, self.shm.buf[state_bytes:2 * state_bytes], n_rays)
+        stamps = np.ndarray((n_robots + 2,), dtype=np.int64, buffer=self.shm.buf, offset=2 * state_bytes)
+        if self.created:
+            stamps[:] = 0
+        self.tick = stamps[0:1]
+        self.stop = stamps[1:2]
+        self.done = stamps[2:]
+
+    def close(self):
+        del self.inputs, self.outputs, self.tick, self.stop, self.done
+        self.shm.close()
+        if self.created:
+            self.shm.unlink()
+
+
+def _run_controllers(ids, config, semaphore, ready):
+    """
+    Worker process running the controllers of the robots ids, on body-less views of the robots
+    """
+    n = config["n_robots"]
+    shared = _SharedState(n, config["state"], config["n_rays"])
+    inbox = SharedMailbox(*config["inbox"])
+    outbox = SharedMailbox(*config["outbox"])
+    local = SwarmState(n, n_rays=config["n_rays"])
+    # the class was imported again by this process, with the parameters of its source
+    robot_class = config["robot_class"]
+    for name, value in config["controller"].items():
+        setattr(robot_class, name, value)
+    robots = [robot_class.view(i, config["dt"], local) for i in ids]
+    ready.wait()
+
+    while True:
+        semaphore.acquire()
+        # if we were late, skip directly to the latest tick
+        while semaphore.acquire(False):
+            pass
+        if shared.stop[0]:
+            break
+
+        # copy the inputs, starting again if the world published a new tick meanwhile
+        while True:
+            t = int(shared.tick[0])
+            if t < 0:
+                time.sleep(0)
+                continue
+            local.pos[ids] = shared.inputs.pos[ids]
+            local.yaw[ids] = shared.inputs.yaw[ids]
+            local.mission_state[ids] = shared.inputs.mission_state[ids]
+            local.neighbors[ids] = shared.inputs.neighbors[ids]
+            local.ranges[ids] = shared.inputs.ranges[ids]
+            local.role[:] = shared.inputs.role
+            messages = [inbox.get(i) for i in ids]
+            if shared.tick[0] == t:
+                break
+
+        for r, received in zip(robots, messages):
+            i = r.slot
+            r.messages_received[:] = received or []
+            r.messages_to_send.clear()
+            local.wheel_dirty[i] = False
+            r.compute_controller()
+            if shared.tick[0] != t:
+                # missed the deadline, the world has moved on
+                break
+            shared.outputs.wheel[i] = local.wheel[i]
+            shared.outputs.wheel_dirty[i] = local.wheel_dirty[i]
+            shared.outputs.mission_state[i] = local.mission_state[i]
+            outbox.put(i, r.messages_to_send)
+            shared.done[i] = t
+
+    del local
+    shared.close()
+    inbox.close()
+    outbox.close()
+
+
+class ControllerPool():
+    """
+    Runs Robot.compute_controller of every robot in worker processes (robots_per_process
+    robots each), as they would run on separate hardware. Each tick the world publishes
+    poses, neighbor lists and delivered messages in shared memory, wakes the workers and
+    collects the wheel commands, mission states and sent messages until deadline seconds
+    have passed. A controller that misses the deadline keeps its last wheel command and
+    sends nothing during that tick. The physics stays in lockstep with the world.
+
+    The robot class must be importable by the workers (i.e. not defined in __main__). Its
+    parameters (see robot.controller_parameters) and navigator are copied to the workers when
+    the pool starts, later changes do not reach them.
+    """
+    def __init__(self, world, robots_per_process=1, deadline=0.004, message_size=4096, start_timeout=60.):
+        self.world = world
+        self.deadline = deadline
+        n = len(world.robots)
+        self.n_robots = n
+        self.shared = _SharedState(n, n_rays=world.swarm.n_rays)
+        self.inbox = SharedMailbox(n, message_size)
+        self.outbox = SharedMailbox(n, message_size)
+        self.tick_count = 0
+        # number of controller results that missed the deadline
+        self.missed = 0
+
+        config = {"n_robots": n,
+                  "n_rays": world.swarm.n_rays,
+                  "dt": world.dt,
+                  "robot_class": type(world.robots[0]),
+                  "controller": dict(controller_parameters(world.robots[0]),
+                                     navigator=world.robots[0].navigator),
+                  "state": self.shared.shm.name,
+                  "inbox": self.inbox.spec(),
+                  "outbox": self.outbox.spec()}
+        context = multiprocessing.get_context("spawn")
+        groups = [list(range(i, min(i + robots_per_process, n))) for i in range(0, n, robots_per_process)]
+        self.semaphores = [context.Semaphore(0) for _ in groups]
+        # passed by every worker once it is set up, so that the imports are not paid during the first ticks
+        ready = context.Barrier(len(groups) + 1)
+        self.workers = [context.Process(target=_run_controllers, args=(ids, config, sem, ready), daemon=True)
+                        for ids, sem in zip(groups, self.semaphores)]
+        for w in self.workers:
+            w.start()
+        try:
+            ready.wait(start_timeout)
+        except threading.BrokenBarrierError:
+            for w in self.workers:
+                w.terminate()
+            self.inbox.close()
+            self.outbox.close()
+            self.shared.close()
+            raise RuntimeError("the controller workers did not start within %.0f s" % start_timeout)
+        world.controller_pool = self
+
+    def compute(self, robots):
+        """
+        Runs one control cycle of all the robots in the workers
+        """
+        shared = self.shared
+        swarm = self.world.swarm
+        t = self.tick_count + 1
+
+        shared.tick[0] = -t
+        shared.inputs.pos[:] = swarm.pos
+        shared.inputs.yaw[:] = swarm.yaw
+        shared.inputs.mission_state[:] = swarm.mission_state
+        shared.inputs.neighbors[:] = swarm.neighbors
+        shared.inputs.ranges[:] = swarm.ranges
+        shared.inputs.role[:] = swarm.role
+        for r in robots:
+            self.inbox.put(r.slot, r.messages_received)
+        shared.tick[0] = t
+        self.tick_count = t
+        for sem in self.semaphores:
+            sem.release()
+
+        end = time.perf_counter() + self.deadline
+        while (shared.done != t).any() and time.perf_counter() < end:
+            time.sleep(0)
+
+        ready = shared.done == t
+        self.missed += self.n_robots - int(ready.sum())
+        for r in robots:
+            i = r.slot
+            if not ready[i]:
+                continue
+            swarm.mission_state[i] = shared.outputs.mission_state[i]
+            if shared.outputs.wheel_dirty[i]:
+                r.set_wheel_velocity(shared.outputs.wheel[i])
+            r.messages_to_send.extend(self.outbox.get(i) or [])
+
+    def close(self):
+        self.shared.stop[0] = 1
+        for sem in self.semaphores:
+            sem.release()
+        for w in self.workers:
+            w.join()
+        self.inbox.close()
+        self.outbox.close()
+        self.shared.close()
+        self.world.controller_pool = None
@@ -0,0 +1,162 @@
+import collections
+
+import pybullet as p
+
+# kind is one of BALL_DELIVERED, ROBOT_IN_REGION, MISSION_COMPLETE, subject is the ball index or
+# robot id (None for MISSION_COMPLETE) and region the name of the goal region (None for MISSION_COMPLETE)
+Event = collections.namedtuple("Event", ["time", "kind", "subject", "region"])
+
+BALL_DELIVERED = "ball delivered"
+ROBOT_IN_REGION = "robot in region"
+MISSION_COMPLETE = "mission complete"
+
+
+class GoalRegion():
+    """
+    Axis aligned box of the scene in which balls are to be delivered
+    """
+    def __init__(self, name, low, high):
+        self.name = name
+        self.low = tuple(low)
+        self.high = tuple(high)
+
+    @classmethod
+    def from_body(cls, name, body, height=1., client=0):
+        """
+        Region covering the body, extended upwards by height so that it contains the balls
+        """
+        low, high = p.getAABB(body, physicsClientId=client)
+        return cls(name, low, (high[0], high[1], max(high[2], low[2] + height)))
+
+    def contains(self, pos):
+        return self.low[0] <= pos[0] <= self.high[0] and self.low[1] <= pos[1] <= self.high[1]
+
+    def distance(self, pos):
+        """
+        Distance from the (x, y) point pos to the region, 0 inside
+        """
+        dx = max(self.low[0] - pos[0], 0., pos[0] - self.high[0])
+        dy = max(self.low[1] - pos[1], 0., pos[1] - self.high[1])
+        return (dx ** 2 + dy ** 2) ** 0.5
+
+
+class MissionEvents():
+    """
+    Detects the progress of the mission from the physics: once per tick, one overlap query per
+    goal region lists the bodies touching it, and the balls and robots whose center is inside
+    a region raise events. The mission is complete once every ball is delivered to its target region.
+
+    Events are appended to pending (drained by poll()) and passed to the callbacks in listeners.
+    """
+    def __init__(self, world, regions=None, targets=None):
+        """
+        targets gives for each ball the (x, y) point to which the mission brings it: the ball
+        is delivered once in the region nearest to that point. Without targets, any region will do.
+        """
+        self.world = world
+        if regions is None:
+            regions = [GoalRegion.from_body("goal%d" % (i + 1), goal, client=world.physicsClient)
+                       for i, goal in enumerate(world.goal_ids)]
+        self.regions = regions
+        self.ball_index = dict((ball, i) for i, ball in enumerate(world.balls))
+        if targets is None:
+            self.targets = [None] * len(world.balls)
+        else:
+            self.targets = [min(regions, key=lambda region: region.distance(point)).name for point in targets]
+        # pybullet id -> slot of the robots, rebuilt when their bodies change (see Robot.set_fidelity)
+        self.robot_bodies = None
+        self.robot_index = {}
+        self.listeners = []
+        self.pending = []
+        # (ball index, region name) and (robot id, region name) pairs currently inside
+        self.delivered = set()
+        self.inside = set()
+        self.complete = False
+        # sets filled by the next update, swapped with delivered and inside so that no tick allocates new ones
+        self._delivered_next = set()
+        self._inside_next = set()
+
+    def update(self):
+        """
+        Checks the regions, called by the world after each simulation step
+        """
+        world = self.world
+        robot_index = self.update_robot_index()
+        delivered = self._delivered_next
+        inside = self._inside_next
+        delivered.clear()
+        inside.clear()
+        for region in self.regions:
+            overlapping = p.getOverlappingObjects(region.low, region.high,
+                                                    physicsClientId=world.physicsClient) or []
+            for body, _ in overlapping:
+                if body in self.ball_index:
+                    if region.contains(world.ball_pos[self.ball_index[body]]):
+                        delivered.add((self.ball_index[body], region.name))
+                elif body in robot_index:
+                    slot = robot_index[body]
+                    if region.contains(world.swarm.pos[slot]):
+                        inside.add((world.robots[slot].id, region.name))
+
+        # the differences are only built on the (rare) ticks where something entered a region
+        if not delivered <= self.delivered:
+            for ball, region in sorted(delivered - self.delivered):
+                self.emit(Event(world.time, BALL_DELIVERED, ball, region))
+        if not inside <= self.inside:
+            for robot, region in sorted(inside - self.inside):
+                self.emit(Event(world.time, ROBOT_IN_REGION, robot, region))
+        # the mission can only complete on a tick where the delivered balls changed
+        changed = delivered != self.delivered
+        self._delivered_next, self.delivered = self.delivered, delivered
+        self._inside_next, self.inside = self.inside, inside
+
+        if changed and not self.complete and all(self.at_target(ball, delivered)
+                                                 for ball in range(len(self.targets))):
+            self.complete = True
+            self.emit(Event(world.time, MISSION_COMPLETE, None, None))
+
+    def update_robot_index(self):
+        """
+        Returns the slot of each robot body, the robot bodies change with their fidelity level
+        """
+        robots = self.world.robots
+        bodies = self.robot_bodies
+        changed = bodies is None
+        if not changed:
+            for i, r in enumerate(robots):
+                if r.pybullet_id != bodies[i]:
+                    changed = True
+                    break
+        if changed:
+            self.robot_bodies = [r.pybullet_id for r in robots]
+            self.robot_index = dict((r.pybullet_id, r.slot) for r in robots)
+        return self.robot_index
+
+    def at_target(self, ball, delivered):
+        """
+        Whether ball is in its target region according to the (ball index, region name) pairs delivered
+        """
+        target = self.targets[ball]
+        return any(b == ball and (target is None or region == target) for b, region in delivered)
+
+    def emit(self, event):
+        self.pending.append(event)
+        for callback in self.listeners:
+            callback(event)
+
+    def poll(self):
+        """
+        Returns the events raised since the last call
+        """
+        events = self.pending
+        self.pending = []
+        return events
+
+    def save(self):
+        return set(self.delivered), set(self.inside), self.complete
+
+    def restore(self, saved):
+        delivered, inside, self.complete = saved
+        self.delivered = set(delivered)
+        self.inside = set(inside)
+        self.pending = []
@@ -0,0 +1,69 @@
+# Several independent Worlds in one process, each with its own pybullet client, stepped in
+# lockstep one after the other. Small batches of experiments run without spawning processes
+# or exchanging data between them.
+#
+#   python multi_world.py --worlds 4 --steps 2000
+#
+#   worlds = MultiWorld(4, fidelity="simple")
+#   worlds.step_all(100)
+#   worlds.close()
+import argparse
+import time
+
+from swarm_simulation import World
+
+
+class MultiWorld():
+    """
+    n_worlds headless Worlds built with world_options (see World).
+    pybullet keeps the GIL during its calls, so threads would not step the worlds any faster
+    than one after the other; worlds that must run in parallel belong in separate processes
+    (e.g. the sessions of control_server.py).
+    """
+    def __init__(self, n_worlds, **world_options):
+        self.worlds = [World(gui=False, **world_options) for _ in range(n_worlds)]
+
+    def step_all(self, steps=1):
+        """
+        Advances every world by steps simulation steps. The worlds are in lockstep: they all
+        finish one step before any starts the next one
+        """
+        for _ in range(steps):
+            for world in self.worlds:
+                world.stepSimulation()
+
+    def run_all(self, steps):
+        """
+        Advances every world by steps simulation steps, one world after the other
+        """
+        for world in self.worlds:
+            for _ in range(steps):
+                world.stepSimulation()
+
+    def reset(self):
+        for world in self.worlds:
+            world.reset()
+
+    def close(self):
+        for world in self.worlds:
+            world.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="steps several worlds of one process")
+    parser.add_argument("--worlds", type=int, default=4)
+    parser.add_argument("--steps", type=int, default=1000)
+    parser.add_argument("--fidelity", default="full", choices=["full", "simple", "auto"])
+    parser.add_argument("--lockstep", action="store_true", help="synchronize the worlds after every step")
+    args = parser.parse_args()
+
+    worlds = MultiWorld(args.worlds, fidelity=args.fidelity)
+    start = time.time()
+    if args.lockstep:
+        worlds.step_all(args.steps)
+    else:
+        worlds.run_all(args.steps)
+    elapsed = time.time() - start
+    print("%d worlds x %d steps in %.2f s: %.1f world steps/s"
+          % (args.worlds, args.steps, elapsed, args.worlds * args.steps / elapsed))
+    worlds.close()
@@ -0,0 +1,208 @@
+import hashlib
+import heapq
+import json
+import os
+
+import numpy as np
+import pybullet as p
+
+from robot import WAYPOINTS
+
+# the 8 moves of the wavefront, as (row, column) offsets
+MOVES = [(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)]
+# bumped when the content of the fields changes, so that fields cached on disk are recomputed
+FIELD_VERSION = 2
+
+
+class NavigationField():
+    """
+    Geodesic distance to one goal over the occupancy grid, and for every cell the unit
+    direction of the shortest path towards the goal. Occupied cells (inside the inflated walls)
+    lead out to the nearest free cell, their distance is the way out plus the distance from there
+    """
+    def __init__(self, distance, direction):
+        self.distance = distance
+        self.direction = direction
+
+
+class Navigator():
+    """
+    Shortest paths around the static walls. The walls are rasterized once into an occupancy grid
+    (inflated by margin, about the robot radius), then for each goal a wavefront (Dijkstra) pass
+    computes the distance-to-goal field, which is cached in memory and on disk keyed by the scene.
+    direction() then answers in O(1).
+
+    To make the leaders use it: Robot.navigator = Navigator(world)
+    """
+    def __init__(self, world, resolution=0.05, margin=0.15, border=3., cache_dir="navigation_cache",
+                 waypoints=None):
+        self.resolution = resolution
+        self.cache_dir = cache_dir
+        self.fields = {}
+
+        boxes = []
+        for wall in world.wall_ids:
+            for link in range(-1, p.getNumJoints(wall, physicsClientId=world.physicsClient)):
+                low, high = p.getAABB(wall, link, physicsClientId=world.physicsClient)
+                boxes.append([low[0] - margin, low[1] - margin, high[0] + margin, high[1] + margin])
+        boxes = np.array(boxes).reshape(-1, 4)
+
+        # the grid covers the walls, the robots and the waypoints with some border around them
+        if waypoints is None:
+            waypoints = list(WAYPOINTS.values())
+        points = np.array([r.initial_position[:2] for r in world.robots] + [w[:2] for w in waypoints], dtype=float)
+        low = np.minimum(boxes[:, :2].min(axis=0), points.min(axis=0)) - border
+        high = np.maximum(boxes[:, 2:].max(axis=0), points.max(axis=0)) + border
+        self.origin = low
+        self.shape = tuple(int(s) for s in np.ceil((high - low) / resolution)[::-1])  # (rows along y, columns along x)
+
+        ys = self.origin[1] + (np.arange(self.shape[0]) + 0.5) * resolution
+        xs = self.origin[0] + (np.arange(self.shape[1]) + 0.5) * resolution
+        self.occupied = np.zeros(self.shape, dtype=bool)
+        for x0, y0, x1, y1 in boxes:
+            rows = (ys >= y0) & (ys <= y1)
+            columns = (xs >= x0) & (xs <= x1)
+            self.occupied |= rows[:, None] & columns[None, :]
+
+        description = {"boxes": np.round(boxes, 4).tolist(), "resolution": resolution,
+                       "origin": self.origin.tolist(), "shape": self.shape, "version": FIELD_VERSION}
+        self.scene_key = hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()[:16]
+
+    def cell(self, pos):
+        """
+        Returns the (row, column) of the cell containing pos, or None outside of the grid
+        """
+        column = int((pos[0] - self.origin[0]) / self.resolution)
+        row = int((pos[1] - self.origin[1]) / self.resolution)
+        if 0 <= row < self.shape[0] and 0 <= column < self.shape[1]:
+            return row, column
+        return None
+
+    def field(self, goal):
+        goal = (float(goal[0]), float(goal[1]))
+        if goal not in self.fields:
+            path = None
+            if self.cache_dir is not None:
+                path = os.path.join(self.cache_dir, "%s_%.3f_%.3f.npz" % (self.scene_key, goal[0], goal[1]))
+            if path is not None and os.path.exists(path):
+                data = np.load(path)
+                field = NavigationField(data["distance"], data["direction"])
+            else:
+                field = self._compute(goal)
+                if path is not None:
+                    if not os.path.isdir(self.cache_dir):
+                        os.makedirs(self.cache_dir)
+                    np.savez(path + ".tmp.npz", distance=field.distance, direction=field.direction)
+                    os.replace(path + ".tmp.npz", path)
+            self.fields[goal] = field
+        return self.fields[goal]
+
+    def _compute(self, goal):
+        rows, columns = self.shape
+        distance = np.full(self.shape, np.inf)
+        start = self.cell(goal)
+        if start is None:
+            raise ValueError("goal %s is outside of the navigation grid" % (goal,))
+
+        # wavefront from the goal over the free cells
+        occupied = self.occupied
+        distance[start] = 0.
+        queue = [(0., start)]
+        costs = [np.hypot(dr, dc) for dr, dc in MOVES]
+        while queue:
+            d, (r, c) = heapq.heappop(queue)
+            if d > distance[r, c]:
+                continue
+            for (dr, dc), cost in zip(MOVES, costs):
+                nr, nc = r + dr, c + dc
+                if 0 <= nr < rows and 0 <= nc < columns and not occupied[nr, nc]:
+                    # no cutting corners between two occupied cells
+                    if dr and dc and (occupied[r, nc] or occupied[nr, c]):
+                        continue
+                    nd = d + cost
+                    if nd < distance[nr, nc]:
+                        distance[nr, nc] = nd
+                        heapq.heappush(queue, (nd, (nr, nc)))
+
+        # direction of steepest descent of the distance, per free cell
+        direction, best_gain = self._descent(distance, costs)
+        free = np.isfinite(distance)
+        direction[~free] = 0.
+        best_gain[~free] = 0.
+
+        # occupied cells: wavefront from the border of the reachable free cells into the walls,
+        # so that a robot that ended up within the margin steers out by the shortest way
+        escape = np.where(free, 0., np.inf)
+        exit_distance = np.where(free, distance, np.inf)
+        padded = np.pad(occupied, 1, constant_values=False)
+        border = np.zeros(self.shape, dtype=bool)
+        for dr, dc in MOVES:
+            border |= padded[1 + dr:1 + dr + rows, 1 + dc:1 + dc + columns]
+        queue = [(0., (r, c)) for r, c in zip(*np.nonzero(free & border))]
+        heapq.heapify(queue)
+        while queue:
+            d, (r, c) = heapq.heappop(queue)
+            if d > escape[r, c]:
+                continue
+            for (dr, dc), cost in zip(MOVES, costs):
+                nr, nc = r + dr, c + dc
+                if 0 <= nr < rows and 0 <= nc < columns and occupied[nr, nc]:
+                    nd = d + cost
+                    if nd < escape[nr, nc]:
+                        escape[nr, nc] = nd
+                        exit_distance[nr, nc] = exit_distance[r, c]
+                        heapq.heappush(queue, (nd, (nr, nc)))
+        inside = occupied & np.isfinite(escape)
+        escape_direction, escape_gain = self._descent(escape, costs)
+        direction[inside] = escape_direction[inside]
+        best_gain[inside] = escape_gain[inside]
+        distance[inside] = escape[inside] + exit_distance[inside]
+
+        # cells with no better neighbor (the goal, unreachable cells) head straight to the goal
+        ys = self.origin[1] + (np.arange(rows) + 0.5) * self.resolution
+        xs = self.origin[0] + (np.arange(columns) + 0.5) * self.resolution
+        straight = np.stack(np.broadcast_arrays(goal[0] - xs[None, :], goal[1] - ys[:, None]), axis=-1)
+        norm = np.linalg.norm(straight, axis=-1, keepdims=True)
+        straight = straight / np.maximum(norm, 1e-9)
+        stuck = best_gain == 0.
+        direction[stuck] = straight[stuck]
+
+        distance = distance * self.resolution
+        return NavigationField(distance.astype(np.float32), direction.astype(np.float32))
+
+    def _descent(self, distance, costs):
+        """
+        Returns (unit direction towards the neighbor of steepest descent of distance, descent
+        per unit length) for every cell; (0, 0) and 0 for cells without a lower neighbor
+        """
+        rows, columns = self.shape
+        padded = np.pad(distance, 1, constant_values=np.inf)
+        best_gain = np.zeros(self.shape)
+        direction = np.zeros(self.shape + (2,))
+        for (dr, dc), cost in zip(MOVES, costs):
+            neighbor = padded[1 + dr:1 + dr + rows, 1 + dc:1 + dc + columns]
+            with np.errstate(invalid="ignore"):
+                gain = (distance - neighbor) / cost
+            better = np.isfinite(neighbor) & (gain > best_gain)
+            best_gain[better] = gain[better]
+            direction[better] = (dc / cost, dr / cost)
+        return direction, best_gain
+
+    def direction(self, pos, goal):
+        """
+        Returns (unit direction to follow from pos to reach goal, remaining path length).
+        Within the wall margin, leads out to the nearest free cell first. Outside of the grid,
+        heads straight to the goal.
+        """
+        field = self.field(goal)
+        cell = self.cell(pos)
+        straight_distance = np.hypot(goal[0] - pos[0], goal[1] - pos[1])
+        # outside of the grid, or near the goal where the cells are too coarse, go straight
+        if cell is None or (straight_distance < 2 * self.resolution and not self.occupied[cell]):
+            straight = (goal[0] - pos[0], goal[1] - pos[1])
+            return np.array(straight) / max(straight_distance, 1e-9), straight_distance
+        distance = float(field.distance[cell])
+        # unreachable cells (enclosed, or deep in a wall) store the straight direction
+        if not np.isfinite(distance):
+            distance = straight_distance
+        return field.direction[cell], distance
@@ -0,0 +1,454 @@
+import multiprocessing
+import os
+import threading
+from multiprocessing import shared_memory
+
+import numpy as np
+import pybullet as p
+
+from robot import Robot, forget_shapes
+from shared_mailbox import SharedMailbox
+from swarm_state import SwarmState
+from swarm_simulation import BALLS, INITIAL_POSITIONS, load_static_scene
+
+# commands broadcast by the main process at the start of each tick
+STEP = 0
+RESET = 1
+STOP = 2
+
+# columns of the shared pose table
+POS = slice(0, 3)
+ORN = slice(3, 7)
+LIN_VEL = slice(7, 10)
+ANG_VEL = slice(10, 13)
+
+# robots per region used to choose the default number of regions: with fewer, exchanging
+# poses, ghosts and messages costs more than the physics saved by splitting
+ROBOTS_PER_REGION = 32
+
+# room kept in the mailbox slots for each message a robot sends or receives ([pos, state]
+# pickles to about 70 bytes)
+MESSAGE_BYTES = 128
+
+
+class SwarmTable():
+    """
+    Shared memory table with the pose and velocity of every entity (robots first, then balls),
+    the region owning each entity, the mission state of each robot and the tick command.
+    """
+    def __init__(self, n_robots, n_balls, name=None):
+        self.n_robots = n_robots
+        self.n_entities = n_robots + n_balls
+        n_floats = self.n_entities * 13
+        n_ints = self.n_entities + n_robots + 1
+        size = 8 * n_floats + 4 * n_ints
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+            self.owner_process = True
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            self.owner_process = False
+        self.pose = np.ndarray((self.n_entities, 13), dtype=np.float64, buffer=self.shm.buf)
+        ints = np.ndarray((n_ints,), dtype=np.int32, buffer=self.shm.buf, offset=8 * n_floats)
+        self.owner = ints[:self.n_entities]
+        self.state = ints[self.n_entities:self.n_entities + n_robots]
+        self.command = ints[self.n_entities + n_robots:]
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def close(self):
+        del self.pose, self.owner, self.state, self.command
+        self.shm.close()
+        if self.owner_process:
+            self.shm.unlink()
+
+
+class Regions():
+    """
+    Splits the arena in vertical strips along x, the outer strips extend to infinity
+    """
+    def __init__(self, n_regions, bounds):
+        self.n_regions = n_regions
+        self.edges = np.linspace(bounds[0], bounds[1], n_regions + 1)
+
+    def region_of(self, x):
+        return int(np.clip(np.searchsorted(self.edges, x, side='right') - 1, 0, self.n_regions - 1))
+
+    def contains(self, index, x, margin=0.):
+        low = -np.inf if index == 0 else self.edges[index] - margin
+        high = np.inf if index == self.n_regions - 1 else self.edges[index + 1] + margin
+        return low <= x < high
+
+
+def _set_static(body, client=0):
+    """
+    Turns a body into a static obstacle (used for the ghosts of bodies owned by other regions)
+    """
+    for link in range(-1, p.getNumJoints(body, physicsClientId=client)):
+        p.changeDynamics(body, link, mass=0., physicsClientId=client)
+
+
+class RegionWorker():
+    """
+    Simulates the entities owned by one region in its own pybullet client.
+    Robots of the neighboring regions that are close to the boundary are mirrored
+    as static ghost bodies, so that contacts across the boundary are still felt.
+    """
+    def __init__(self, index, config):
+        self.index = index
+        self.dt = config["dt"]
+        self.max_communication_distance = config["max_communication_distance"]
+        self.margin = config["margin"]
+        self.initial_positions = config["initial_positions"]
+        self.regions = Regions(config["n_regions"], config["bounds"])
+
+        self.client = p.connect(p.DIRECT)
+        p.setGravity(0,0,-9.81, physicsClientId=self.client)
+        p.setPhysicsEngineParameter(self.dt, numSubSteps=1, physicsClientId=self.client)
+        load_static_scene(self.client)
+
+        self.timeout = config["timeout"]
+        self.table = SwarmTable(len(self.initial_positions), len(BALLS), name=config["table"])
+        self.outbox = SharedMailbox(*config["outbox"])
+        self.handoff = SharedMailbox(*config["handoff"])
+        self.n_robots = self.table.n_robots
+        # local copy of the state of the whole swarm, the owned robots are views on it
+        self.swarm = SwarmState(self.n_robots)
+
+        self.robots = {}  # robot id -> Robot owned by this region
+        self.balls = {}   # entity index -> pybullet id of a ball owned by this region
+        self.ghosts = {}  # entity index -> pybullet id of a ghost body
+        self.time = 0.0
+
+    def run(self, barrier):
+        try:
+            while True:
+                # no timeout here, the main process may pause between two ticks
+                barrier.wait()
+                command = self.table.command[0]
+                if command == STOP:
+                    break
+                if command == RESET:
+                    self.clear()
+                self.sync()
+                # a reset only places the entities, they start moving with the next step
+                if command == STEP:
+                    self.exchange_messages()
+                    if self.time > 1.0:
+                        for r in self.robots.values():
+                            r.compute_controller()
+                    for r in self.robots.values():
+                        r.apply_wheel_velocity()
+                barrier.wait(self.timeout)
+                self.publish_outboxes()
+                if command == STEP:
+                    p.stepSimulation(physicsClientId=self.client)
+                    self.time += self.dt
+                self.publish_poses()
+                barrier.wait(self.timeout)
+        except threading.BrokenBarrierError:
+            # another region or the main process failed
+            pass
+        except Exception:
+            # wake up the others instead of leaving them waiting for this region
+            barrier.abort()
+            raise
+        finally:
+            p.disconnect(physicsClientId=self.client)
+        forget_shapes(self.client)
+
+    def clear(self):
+        """
+        Removes every local body and forgets the state of the swarm (wheel commands, ...), the
+        entities are then adopted back from the (reset) table
+        """
+        for r in self.robots.values():
+            p.removeBody(r.pybullet_id, physicsClientId=self.client)
+        for body in list(self.balls.values()) + list(self.ghosts.values()):
+            p.removeBody(body, physicsClientId=self.client)
+        self.robots = {}
+        self.balls = {}
+        self.ghosts = {}
+        self.swarm = SwarmState(self.n_robots)
+        self.time = 0.0
+
+    def _load(self, e):
+        if e < self.n_robots:
+            return p.loadSDF("../models/robot.sdf", physicsClientId=self.client)[0]
+        return p.loadURDF(BALLS[e - self.n_robots][0], physicsClientId=self.client)
+
+    def _place(self, body, e):
+        row = self.table.pose[e]
+        p.resetBasePositionAndOrientation(body, row[POS], row[ORN], physicsClientId=self.client)
+        p.resetBaseVelocity(body, row[LIN_VEL], row[ANG_VEL], physicsClientId=self.client)
+
+    def adopt(self, e):
+        """
+        Takes ownership of entity e, restoring the controller state handed off by its previous region
+        """
+        if e in self.ghosts:
+            p.removeBody(self.ghosts.pop(e), physicsClientId=self.client)
+        if e >= self.n_robots:
+            body = self._load(e)
+            self._place(body, e)
+            self.balls[e] = body
+            return
+        r = Robot(self.table.pose[e, POS], e, self.dt, self.swarm, client=self.client)
+        r.initial_position = self.initial_positions[e]
+        self._place(r.pybullet_id, e)
+        blob = self.handoff.get(e)
+        if blob is not None:
+            wheel_velocity = blob.pop("wheel_velocity")
+            r.set_controller_state(blob)
+            r.set_wheel_velocity(wheel_velocity)
+            self.handoff.put(e, None)
+        self.robots[e] = r
+
+    def release(self, e, new_owner):
+        """
+        Hands entity e over to another region and keeps its body as a ghost. Ghosts are static,
+        see the limitation in PartitionedWorld
+        """
+        self.table.owner[e] = new_owner
+        if e >= self.n_robots:
+            body = self.balls.pop(e)
+        else:
+            r = self.robots.pop(e)
+            body = r.pybullet_id
+            blob = r.get_controller_state()
+            joint_states = p.getJointStates(body, r.joint_ids, physicsClientId=self.client)
+            blob["wheel_velocity"] = [s[1] for s in joint_states]
+            self.handoff.put(e, blob)
+        _set_static(body, self.client)
+        self.ghosts[e] = body
+
+    def sync(self):
+        """
+        Adopts the entities migrated to this region and updates the ghosts
+        """
+        for e in range(self.table.n_entities):
+            owned = e in self.robots or e in self.balls
+            if self.table.owner[e] == self.index:
+                if not owned:
+                    self.adopt(e)
+                continue
+            x = self.table.pose[e, 0]
+            if self.regions.contains(self.index, x, self.margin):
+                if e not in self.ghosts:
+                    body = self._load(e)
+                    _set_static(body, self.client)
+                    self.ghosts[e] = body
+                row = self.table.pose[e]
+                p.resetBasePositionAndOrientation(self.ghosts[e], row[POS], row[ORN],
+                                                  physicsClientId=self.client)
+            elif e in self.ghosts:
+                p.removeBody(self.ghosts.pop(e), physicsClientId=self.client)
+
+    def exchange_messages(self):
+        """
+        Builds the neighbor lists of the owned robots and delivers the messages
+        that were published in the shared outboxes during the previous tick
+        """
+        self.swarm.pos[:] = self.table.pose[:self.n_robots, POS]
+        for i in self.robots:
+            self.swarm.yaw[i] = p.getEulerFromQuaternion(self.table.pose[i, ORN])[2]
+        self.swarm.update_neighbors(self.max_communication_distance, rows=self.robots)
+        outboxes = {}
+        for i, r in self.robots.items():
+            r.messages_received.clear()
+            for j in r.neighbors:
+                if j not in outboxes:
+                    outboxes[j] = self.outbox.get(j) or []
+                for msg in outboxes[j]:
+                    if msg[0] == i:
+                        r.messages_received.append((j, msg[1]))
+
+    def publish_outboxes(self):
+        for i, r in self.robots.items():
+            self.outbox.put(i, r.messages_to_send)
+            r.messages_to_send.clear()
+
+    def publish_poses(self):
+        bodies = [(i, r.pybullet_id) for i, r in self.robots.items()] + list(self.balls.items())
+        for e, body in bodies:
+            pos, orn = p.getBasePositionAndOrientation(body, physicsClientId=self.client)
+            lin, ang = p.getBaseVelocity(body, physicsClientId=self.client)
+            row = self.table.pose[e]
+            row[POS] = pos
+            row[ORN] = orn
+            row[LIN_VEL] = lin
+            row[ANG_VEL] = ang
+            if e < self.n_robots:
+                self.table.state[e] = self.robots[e].state
+            new_owner = self.regions.region_of(pos[0])
+            if new_owner != self.index:
+                self.release(e, new_owner)
+
+
+def _run_region(index, config, barrier):
+    try:
+        worker = RegionWorker(index, config)
+    except Exception:
+        barrier.abort()
+        raise
+    worker.run(barrier)
+
+
+class RobotView():
+    """
+    Read-only view, in the main process, of a robot simulated by one of the regions
+    """
+    def __init__(self, world, robot_id):
+        self.world = world
+        self.id = robot_id
+
+    @property
+    def state(self):
+        return int(self.world.table.state[self.id])
+
+    @property
+    def region(self):
+        return int(self.world.table.owner[self.id])
+
+    def get_pos_and_orientation(self):
+        row = self.world.table.pose[self.id]
+        x, y, z, w = row[ORN]
+        yaw = np.arctan2(2. * (w * z + x * y), 1. - 2. * (y * y + z * z))
+        return row[POS].copy(), yaw
+
+
+class PartitionedWorld():
+    """
+    A World split into regions along x, each simulated by its own worker process
+    with its own pybullet client. Robots migrate between regions when they cross a
+    boundary, and messages between neighbors go through shared memory, so the
+    controllers (Robot.compute_controller) run unchanged inside the workers.
+
+    Limitation: bodies owned by another region are static ghosts (mass 0), balls included. A
+    robot cannot push a ball owned by another region: once a ball crosses a boundary ahead of
+    the robots pushing it, it is a fixed obstacle for them. Missions where the swarm pushes the
+    balls across boundaries need a single region.
+
+    n_regions defaults to one region per ROBOTS_PER_REGION robots (at most one per cpu), and
+    message_size, the size of the mailbox slot of a robot, to room for a message from and to
+    every other robot. A tick that a region fails or does not finish within timeout seconds
+    raises a RuntimeError and stops the workers.
+    """
+    def __init__(self, n_regions=None, init_positions=None, bounds=(-1., 7.), margin=0.5,
+                 message_size=None, timeout=30.):
+        if init_positions is None:
+            init_positions = INITIAL_POSITIONS
+        n_robots = len(init_positions)
+        if n_regions is None:
+            n_regions = max(1, min(os.cpu_count() or 1, -(-n_robots // ROBOTS_PER_REGION)))
+        if message_size is None:
+            # the slots are only backed by memory where written, large slots cost little
+            message_size = max(4096, SharedMailbox.HEADER + 2 * MESSAGE_BYTES * n_robots)
+        self.timeout = timeout
+
+        self.max_communication_distance = 2.0
+        self.dt = 1./250.
+        self.regions = Regions(n_regions, bounds)
+
+        self.table = SwarmTable(n_robots, len(BALLS))
+        # one outbox per robot with the messages it sent during the last tick, and one
+        # handoff slot per robot with its controller state while it migrates
+        self.outbox = SharedMailbox(n_robots, message_size)
+        self.handoff = SharedMailbox(n_robots, message_size)
+        self.initial_pose = np.zeros_like(self.table.pose)
+        for i, pos in enumerate(init_positions):
+            self.initial_pose[i, POS] = pos
+            self.initial_pose[i, ORN] = (0., 0., 0., 1.)
+        for b, (urdf, pos, orn) in enumerate(BALLS):
+            self.initial_pose[n_robots + b, POS] = pos
+            self.initial_pose[n_robots + b, ORN] = orn
+        self._reset_table()
+
+        config = {"dt": self.dt,
+                  "max_communication_distance": self.max_communication_distance,
+                  "margin": margin,
+                  "n_regions": n_regions,
+                  "bounds": bounds,
+                  "timeout": timeout,
+                  "initial_positions": [list(pos) for pos in init_positions],
+                  "table": self.table.name,
+                  "outbox": self.outbox.spec(),
+                  "handoff": self.handoff.spec()}
+
+        context = multiprocessing.get_context("spawn")
+        self.barrier = context.Barrier(n_regions + 1)
+        self.workers = [context.Process(target=_run_region, args=(i, config, self.barrier), daemon=True)
+                        for i in range(n_regions)]
+        for w in self.workers:
+            w.start()
+
+        self.robots = [RobotView(self, i) for i in range(n_robots)]
+        self.time = 0.0
+
+        self.stepSimulation()
+        self.stepSimulation()
+
+    def _reset_table(self):
+        self.table.pose[:] = self.initial_pose
+        self.table.state[:] = 0
+        for e in range(self.table.n_entities):
+            self.table.owner[e] = self.regions.region_of(self.table.pose[e, 0])
+        self.outbox.clear()
+        self.handoff.clear()
+
+    def _tick(self, command):
+        self.table.command[0] = command
+        try:
+            self.barrier.wait(self.timeout)  # regions read the table, deliver messages and run the controllers
+            self.barrier.wait(self.timeout)  # regions step the physics and publish poses and migrations
+            self.barrier.wait(self.timeout)
+        except threading.BrokenBarrierError:
+            self._stop_workers()
+            raise RuntimeError("a region failed or did not finish the tick within %.0f s" % self.timeout)
+
+    def _stop_workers(self):
+        self.barrier.abort()
+        for w in self.workers:
+            w.join(self.timeout)
+            if w.is_alive():
+                w.terminate()
+
+    def reset(self):
+        """
+        Resets the position of all the robots and balls
+        """
+        self._reset_table()
+        self._tick(RESET)
+        self.time = 0.0
+
+    def stepSimulation(self):
+        """
+        Simulates one step simulation in all the regions
+        """
+        self._tick(STEP)
+        self.time += self.dt
+
+    def close(self):
+        if not self.barrier.broken:
+            self.table.command[0] = STOP
+            try:
+                self.barrier.wait(self.timeout)
+            except threading.BrokenBarrierError:
+                pass
+        self._stop_workers()
+        self.outbox.close()
+        self.handoff.close()
+        self.table.close()
+
+
+if __name__ == "__main__":
+    import time
+
+    world = PartitionedWorld()
+    start = time.time()
+    for _ in range(2500):
+        world.stepSimulation()
+    print("%d regions: %.1f steps/s" % (len(world.workers), 2500 / (time.time() - start)))
+    world.close()
@@ -0,0 +1,88 @@
+import time
+
+import pybullet as p
+
+
+class RenderBudget():
+    """
+    Paces a GUI simulation. Rendering is switched off with configureDebugVisualizer and only
+    switched back on for one step every 1/display_rate seconds of wall time, and the
+    simulation is slowed down to speed times real time (speed=None runs as fast as possible).
+
+    The pacing follows an absolute schedule (wall time = start + simulated time / speed), so
+    small delays are caught up on later instead of accumulating. When the simulation falls
+    more than max_lag seconds behind, frames are dropped until it catches up (but at least one
+    frame is shown every max_frame_gap seconds), and after resync_lag seconds behind the
+    schedule is restarted from the current time rather than running in a burst.
+    """
+    def __init__(self, world, display_rate=30., speed=1., max_lag=0.05, max_frame_gap=1.0, resync_lag=1.0):
+        self.world = world
+        self.frame_period = 1. / display_rate
+        self.speed = speed
+        self.max_lag = max_lag
+        self.max_frame_gap = max_frame_gap
+        self.resync_lag = resync_lag
+
+        self.frames = 0
+        self.dropped_frames = 0
+        self.steps = 0
+        self.rendering = None
+        self._set_rendering(False)
+        self.resync()
+
+    def resync(self):
+        """
+        Restarts the pacing schedule from the current wall and simulated time
+        """
+        self.start_wall = time.perf_counter()
+        self.start_sim = self.world.time
+        self.last_frame = self.start_wall
+        self.last_shown = self.start_wall
+
+    def _set_rendering(self, enabled):
+        if enabled != self.rendering:
+            p.configureDebugVisualizer(p.COV_ENABLE_RENDERING, int(enabled),
+                                       physicsClientId=self.world.physicsClient)
+            self.rendering = enabled
+
+    def lag(self):
+        """
+        Wall time (s) by which the simulation is behind its schedule, negative when ahead
+        """
+        if self.speed is None:
+            return 0.
+        target = self.start_wall + (self.world.time - self.start_sim) / self.speed
+        return time.perf_counter() - target
+
+    def step(self):
+        """
+        Simulates one step of the world, rendering and sleeping as needed
+        """
+        now = time.perf_counter()
+        render = False
+        if now - self.last_frame >= self.frame_period:
+            self.last_frame = now
+            if self.lag() < self.max_lag or now - self.last_shown >= self.max_frame_gap:
+                render = True
+                self.frames += 1
+                self.last_shown = now
+            else:
+                self.dropped_frames += 1
+        self._set_rendering(render)
+
+        self.world.stepSimulation()
+        self.steps += 1
+
+        lag = self.lag()
+        if lag < 0.:
+            time.sleep(-lag)
+        elif lag > self.resync_lag:
+            self.resync()
+
+    def stats(self):
+        wall = time.perf_counter() - self.start_wall
+        return {"steps": self.steps,
+                "frames": self.frames,
+                "dropped_frames": self.dropped_frames,
+                "real_time_factor": (self.world.time - self.start_sim) / wall if wall > 0 else 0.,
+                "lag": self.lag()}
@@ -1,54 +1,359 @@
+import copy
+
 import numpy as np
 import pybullet as p
 import itertools
 
+from swarm_state import SwarmState
+
+# desired relative positions of the formations. For square and line the offset of
+# robot i with respect to neighbor j is read at [i][j], for the others at [j][i]
+SQUARE_X = np.array([[0,0.5,1,1,0.5,0],
+                     [-0.5,0,0.5,0.5,0,-0.5],
+                     [-1,-0.5,0,0,-0.5,-1],
+                     [-1,-0.5,0,0,-0.5,-1],
+                     [-0.5,0,0.5,0.5,0,-0.5],
+                     [0,0.5,1,1,0.5,0]])
+
+SQUARE_Y = np.array([[0,0,0,-1,-1,-1],
+                     [0,0,0,-1,-1,-1],
+                     [0,0,0,-1,-1,-1],
+                     [1,1,1,0,0,0],
+                     [1,1,1,0,0,0],
+                     [1,1,1,0,0,0]])
+
+LINE_Y = np.array([[0,-0.5*0.9,-1*0.9,-1.5*0.9,-2*0.9,-2.5*0.9],
+                   [0.5*0.9,0,-0.5*0.9,-1*0.9,-1.5*0.9,-2*0.9],
+                   [1*0.9,0.5*0.9,0,-0.5*0.9,-1*0.9,-1.5*0.9],
+                   [1.5*0.9,1*0.9,0.5*0.9,0,-0.5*0.9,-1*0.9],
+                   [2*0.9,1.5*0.9,1*0.9,0.5*0.9,0,-0.5*0.9],
+                   [2.5*0.9,2*0.9,1.5*0.9,1*0.9,0.5*0.9,0]])
+
+CIRCLE2_X = np.array([[0,0.866,0.866,0,-0.866,-0.866],
+                      [-0.866,0,0,-0.866,-0.866*2,-0.866*2],
+                      [-0.866,0,0,-0.866,-0.866*2,-0.866*2],
+                      [0,0.866,0.866,0,-0.866,-0.866],
+                      [0.866,0.866*2,0.866*2,0.866,0,0],
+                      [0.866,0.866*2,0.866*2,0.866,0,0]])
+
+CIRCLE2_Y = np.array([[0,0.5,1.5,2,1.5,0.5],
+                      [-0.5,0,1,1.5,1,0],
+                      [-1.5,-1,0,0.5,0,-1],
+                      [-2,-1.5,-0.5,0,-0.5,-1.5],
+                      [-1.5,-1,0,0.5,0,-1],
+                      [-0.5,0,1,1.5,1,0]])
+
+# circle1 is circle2 shrunk to 40%
+CIRCLE1_X = CIRCLE2_X * 0.4
+CIRCLE1_Y = CIRCLE2_Y * 0.4
+
+DIAMOND_X = np.array([[0,0.5*0.9,0,-0.5*0.9,-0.5*0.9,-0.5*0.9],
+                      [-0.5*0.9,0,-0.5*0.9,-1*0.9,-1*0.9,-1*0.9],
+                      [0,0.5*0.9,0,-0.5*0.9,-0.5*0.9,-0.5*0.9],
+                      [0.5*0.9,1*0.9,0.5*0.9,0,0,0],
+                      [0.5*0.9,1*0.9,0.5*0.9,0,0,0],
+                      [0.5*0.9,1*0.9,0.5*0.9,0,0,0]])
+
+DIAMOND_Y = np.array([[0,1*0.9,2*0.9,1.5*0.9,1*0.9,0.5*0.9],
+                      [-1*0.9,0,1*0.9,0.5*0.9,0,-0.5*0.9],
+                      [-2*0.9,-1*0.9,0,-0.5*0.9,-1*0.9,-1.5*0.9],
+                      [-1.5*0.9,-0.5*0.9,0.5*0.9,0,-0.5*0.9,-1*0.9],
+                      [-1*0.9,0,1*0.9,0.5*0.9,0,-0.5*0.9],
+                      [-0.5*0.9,0.5*0.9,1.5*0.9,1*0.9,0.5*0.9,0]])
+
+# position of each robot in the formations, relative to robot 0
+FORMATION_SLOTS = {
+    "square": np.stack([SQUARE_X[:, 0], SQUARE_Y[:, 0]], axis=1),
+    "line": np.stack([np.zeros(6), LINE_Y[:, 0]], axis=1),
+    "circle1": np.stack([CIRCLE1_X[0], CIRCLE1_Y[0]], axis=1),
+    "circle2": np.stack([CIRCLE2_X[0], CIRCLE2_Y[0]], axis=1),
+    "diamond": np.stack([DIAMOND_X[0], DIAMOND_Y[0]], axis=1),
+}
+
+# formation held by the followers during each mission state
+PHASE_FORMATIONS = {0: "line", 1: "circle2", 2: "circle2", 3: "circle1", 4: "circle2", 5: "circle2", 6: "circle1"}
+
+# mission states in which the swarm pushes a ball
+CONTACT_PHASES = (3, 6)
+
+# waypoint driven to by the leader during each mission state
+WAYPOINTS = {0: (2.5, 10), 2: (2.5, 3), 3: (2.4, 6), 4: (6.1, 4.9), 5: (4.5, 0), 6: (0.2, 6)}
+
+# (client, radius, height) -> collision and visual shapes of the simple model, shared by all
+# the simple bodies of a physics client
+SIMPLE_SHAPES = {}
+
+
+def forget_shapes(client):
+    """
+    Drops the shapes of a physics client, to be called when disconnecting from it
+    """
+    for key in [key for key in SIMPLE_SHAPES if key[0] == client]:
+        del SIMPLE_SHAPES[key]
+
+
+def controller_parameters(robot):
+    """
+    Returns the class level parameters (gains, modes, ...) of a robot controller
+    """
+    params = {}
+    for klass in reversed(type(robot).__mro__):
+        for name, value in vars(klass).items():
+            if not name.startswith("_") and isinstance(value, (bool, int, float, str, tuple)):
+                params[name] = value
+    return params
+
+
+def formation_error(positions, formation, roles=None):
+    """
+    Largest distance between a robot and its slot in the formation, once both are centered
+    on their centroid. positions is an (..., robots, 2) array, the result has shape (...).
+    roles gives the slot of each robot, (robots,) or (..., robots) when it changes along positions,
+    by default robot i holds slot i.
+    """
+    slots = FORMATION_SLOTS[formation]
+    if roles is not None:
+        slots = slots[roles]
+    error = (positions - positions.mean(axis=-2, keepdims=True)) - (slots - slots.mean(axis=-2, keepdims=True))
+    return np.sqrt((error ** 2).sum(axis=-1)).max(axis=-1)
+
 class Robot():
     """ 
-    The class is the interface to a single robot
+    The class is the interface to a single robot.
+    Its pose, mission state, wheel command and neighbors live in a SwarmState shared
+    with the rest of the swarm (the robot is the row robot_id of it).
     """
-    def __init__(self, init_pos, robot_id, dt):
+    __slots__ = ("id", "dt", "swarm", "slot", "pybullet_id", "joint_ids", "initial_position",
+                 "messages_received", "messages_to_send", "fidelity", "client")
+
+    # control law used by drive(), see drive() for the available modes
+    controller_mode = "consensus"
+    # displacement under which the scheduled gain starts to be boosted, and the largest boost
+    error_reference = 0.5
+    max_gain_boost = 5.
+    # turn_drive: heading error (rad) above which the robot turns on the spot, and turning gain
+    turn_threshold = 0.5
+    turn_gain = 5.
+    max_wheel_speed = 30.
+    # navigation.Navigator used by the leaders to go around the walls, None to drive straight
+    navigator = None
+    # range sensor: number of rays (0 for no sensor), spread evenly over range_fov (rad) around
+    # the heading, maximum range (m), distance from the center at which the rays start (outside
+    # of the robot body) and number of simulation steps between two readings
+    range_rays = 0
+    range_fov = np.pi
+    range_max = 2.
+    range_offset = 0.12
+    range_period = 1
+    # simple fidelity model: a cylinder driven by its base velocity following the differential
+    # drive kinematics of the full model (wheel radius and distance between the wheels, in m)
+    body_radius = 0.1
+    body_height = 0.1
+    body_mass = 1.
+    wheel_radius = 0.05
+    wheel_base = 0.2
+
+    # attributes making up the controller state, see get_controller_state
+    CONTROLLER_ATTRIBUTES = ("state", "messages_to_send", "messages_received")
+
+    def __init__(self, init_pos, robot_id, dt, swarm=None, fidelity="full", client=0):
         self.id = robot_id
         self.dt = dt
+        # pybullet physics client holding the body of the robot
+        self.client = client
+        if swarm is None:
+            # standalone robot
+            swarm = SwarmState(1, n_rays=self.range_rays)
+            swarm.ranges.fill(self.range_max)
+            self.slot = 0
+        else:
+            self.slot = robot_id
+        self.swarm = swarm
         self.state = 0
-        self.pybullet_id = p.loadSDF("../models/robot.sdf")[0]
-        self.joint_ids = list(range(p.getNumJoints(self.pybullet_id)))
         self.initial_position = init_pos
+        self.fidelity = fidelity
+        self._load_body()
         self.reset()
+        self.update_pose()
 
-        # No friction between bbody and surface.
-        p.changeDynamics(self.pybullet_id, -1, lateralFriction=5., rollingFriction=0.)
-
-        # Friction between joint links and surface.
-        for i in range(p.getNumJoints(self.pybullet_id)):
-            p.changeDynamics(self.pybullet_id, i, lateralFriction=5., rollingFriction=0.)
-            
         self.messages_received = []
         self.messages_to_send = []
-        self.neighbors = []
+
+    @classmethod
+    def view(cls, robot_id, dt, swarm):
+        """
+        Creates a robot without pybullet body, that only reads and writes its row of swarm.
+        Used to run the controllers outside of the process holding the simulation.
+        """
+        r = cls.__new__(cls)
+        r.id = robot_id
+        r.dt = dt
+        r.swarm = swarm
+        r.slot = robot_id
+        r.pybullet_id = None
+        r.joint_ids = []
+        r.initial_position = None
+        r.fidelity = None
+        r.client = None
+        r.messages_received = []
+        r.messages_to_send = []
+        return r
         
+    @property
+    def state(self):
+        """
+        mission state of the robot
+        """
+        return int(self.swarm.mission_state[self.slot])
+
+    @state.setter
+    def state(self, value):
+        self.swarm.mission_state[self.slot] = value
+
+    @classmethod
+    def formation_for(cls, state):
+        """
+        Name of the formation held during the mission state (None if there is none),
+        used by the world to assign the robots to the formation slots
+        """
+        return PHASE_FORMATIONS.get(state)
+
+    def role(self, robot_id):
+        """
+        Returns the formation slot assigned to robot robot_id (its id unless the world reassigns them)
+        """
+        return int(self.swarm.role[robot_id])
+
+    @property
+    def neighbors(self):
+        return np.flatnonzero(self.swarm.neighbors[self.slot]).tolist()
+
+    def _load_body(self):
+        """
+        Creates the pybullet body of the current fidelity level:
+        - full: models/robot.sdf, wheels driven by their joint motors
+        - simple: a single cylinder without joints, moved by setting its base velocity
+        """
+        if self.fidelity == "full":
+            self.pybullet_id = p.loadSDF("../models/robot.sdf", physicsClientId=self.client)[0]
+            self.joint_ids = list(range(p.getNumJoints(self.pybullet_id, physicsClientId=self.client)))
+
+            # No friction between bbody and surface.
+            p.changeDynamics(self.pybullet_id, -1, lateralFriction=5., rollingFriction=0., physicsClientId=self.client)
+
+            # Friction between joint links and surface.
+            for i in range(p.getNumJoints(self.pybullet_id, physicsClientId=self.client)):
+                p.changeDynamics(self.pybullet_id, i, lateralFriction=5., rollingFriction=0.,
+                                 physicsClientId=self.client)
+        elif self.fidelity == "simple":
+            key = (self.client, self.body_radius, self.body_height)
+            if key not in SIMPLE_SHAPES:
+                SIMPLE_SHAPES[key] = (
+                    p.createCollisionShape(p.GEOM_CYLINDER, radius=self.body_radius, height=self.body_height,
+                                           physicsClientId=self.client),
+                    p.createVisualShape(p.GEOM_CYLINDER, radius=self.body_radius, length=self.body_height,
+                                        rgbaColor=(0.2, 0.2, 0.8, 1.), physicsClientId=self.client))
+            shape, visual = SIMPLE_SHAPES[key]
+            self.pybullet_id = p.createMultiBody(self.body_mass, shape, visual, physicsClientId=self.client)
+            self.joint_ids = []
+            # the base velocity is imposed every step, the floor must not slow it down
+            p.changeDynamics(self.pybullet_id, -1, lateralFriction=0., rollingFriction=0., spinningFriction=0.,
+                             linearDamping=0., angularDamping=0., physicsClientId=self.client)
+        else:
+            raise ValueError("unknown fidelity %s" % self.fidelity)
+
+    def set_fidelity(self, fidelity):
+        """
+        Replaces the pybullet body by the one of another fidelity level, at the same pose
+        and with the same velocity
+        """
+        if fidelity == self.fidelity:
+            return
+        pos, orn = p.getBasePositionAndOrientation(self.pybullet_id, physicsClientId=self.client)
+        linear, angular = p.getBaseVelocity(self.pybullet_id, physicsClientId=self.client)
+        p.removeBody(self.pybullet_id, physicsClientId=self.client)
+        self.fidelity = fidelity
+        self._load_body()
+        p.resetBasePositionAndOrientation(self.pybullet_id, pos, orn, physicsClientId=self.client)
+        p.resetBaseVelocity(self.pybullet_id, linear, angular, physicsClientId=self.client)
+        # the new body has no motor command yet
+        self.swarm.wheel_dirty[self.slot] = True
+        self.swarm.wheel_sent[self.slot] = np.nan
 
     def reset(self):
         """
         Moves the robot back to its initial position 
         """
-        p.resetBasePositionAndOrientation(self.pybullet_id, self.initial_position, (0., 0., 0., 1.))
+        p.resetBasePositionAndOrientation(self.pybullet_id, self.initial_position, (0., 0., 0., 1.),
+                                          physicsClientId=self.client)
+
+    def get_controller_state(self):
+        """
+        Returns a copy of the controller state (mission state, pending messages, ...),
+        i.e. everything except the pybullet body
+        """
+        state = dict((k, getattr(self, k)) for k in self.CONTROLLER_ATTRIBUTES)
+        # attributes added by subclasses without __slots__
+        state.update(getattr(self, "__dict__", {}))
+        return copy.deepcopy(state)
+
+    def set_controller_state(self, state):
+        """
+        Restores a controller state returned by get_controller_state
+        """
+        for k, v in copy.deepcopy(state).items():
+            setattr(self, k, v)
             
     def set_wheel_velocity(self, vel):
         """ 
         Sets the wheel velocity,expects an array containing two numbers (left and right wheel vel) 
+        The command is sent to pybullet by the world just before the next simulation step.
         """
-        assert len(vel) == 2, "Expect velocity to be array of size two"
-        p.setJointMotorControlArray(self.pybullet_id, self.joint_ids, p.VELOCITY_CONTROL,
-            targetVelocities=vel)
+        self.swarm.wheel[self.slot] = vel
+        self.swarm.wheel_dirty[self.slot] = True
+
+    def apply_wheel_velocity(self):
+        """
+        Sends the wheel velocity set since the last call (if any) to pybullet.
+        The simple model has no motor holding the velocity, its base velocity is set every step.
+        """
+        if self.fidelity == "simple":
+            left, right = self.swarm.wheel[self.slot]
+            yaw = self.swarm.yaw[self.slot]
+            speed = self.wheel_radius * (left + right) / 2.
+            turn = self.wheel_radius * (right - left) / self.wheel_base
+            p.resetBaseVelocity(self.pybullet_id, (speed * np.cos(yaw), speed * np.sin(yaw), 0.), (0., 0., turn),
+                                physicsClientId=self.client)
+            self.swarm.wheel_dirty[self.slot] = False
+        elif self.swarm.wheel_dirty[self.slot]:
+            p.setJointMotorControlArray(self.pybullet_id, self.joint_ids, p.VELOCITY_CONTROL,
+                targetVelocities=self.swarm.wheel[self.slot], physicsClientId=self.client)
+            self.swarm.wheel_sent[self.slot] = self.swarm.wheel[self.slot]
+            self.swarm.wheel_dirty[self.slot] = False
+
+    def update_pose(self):
+        """
+        Reads the pose of the robot from pybullet into the swarm state
+        """
+        pos, rot = p.getBasePositionAndOrientation(self.pybullet_id, physicsClientId=self.client)
+        self.swarm.pos[self.slot] = pos
+        self.swarm.yaw[self.slot] = p.getEulerFromQuaternion(rot)[2]
 
     def get_pos_and_orientation(self):
         """
-        Returns the position and orientation (as Yaw angle) of the robot.
+        Returns the position and orientation (as Yaw angle) of the robot,
+        as of the last update of the swarm state.
         """
-        pos, rot = p.getBasePositionAndOrientation(self.pybullet_id)
-        euler = p.getEulerFromQuaternion(rot)
-        return np.array(pos), euler[2]
+        return self.swarm.pos[self.slot].copy(), float(self.swarm.yaw[self.slot])
     
+    def get_ranges(self):
+        """
+        Returns the distances measured by the range sensor, one per ray from the leftmost
+        to the rightmost, range_max when the ray hits nothing. Updated by the world
+        every range_period simulation steps.
+        """
+        return self.swarm.ranges[self.slot].copy()
+
     def get_messages(self):
         """
         returns a list of received messages, each element of the list is a tuple (a,b)
@@ -61,99 +366,87 @@ class Robot():
         """
         sends a message to robot with id number robot_id, the message can be any object, list, etc
         """
-        self.messages_to_send.append([robot_id, message])
+        self.messages_to_send.append((robot_id, message))
         
     def get_neighbors(self):
         """
         returns a list of neighbors (i.e. robots within 2m distance) to which messages can be sent
         """
         return self.neighbors     
+    def desired_distance_square(self,robot_id,  m):
+        """
+        set a list of desired distance, using robot_id to pick
+        """
+        i, j = self.role(robot_id), self.role(m[0])
+        return SQUARE_X[i][j], SQUARE_Y[i][j]
+
     def desired_distance_line(self,robot_id,  m):
         """
         set a list of desired distance, using robot_id to pick
         """        
-        desired_distance_y = np.array([[0,-0.5*0.9,-1*0.9,-1.5*0.9,-2*0.9,-2.5*0.9],
-                                       [0.5*0.9,0,-0.5*0.9,-1*0.9,-1.5*0.9,-2*0.9],
-                                       [1*0.9,0.5*0.9,0,-0.5*0.9,-1*0.9,-1.5*0.9],
-                                       [1.5*0.9,1*0.9,0.5*0.9,0,-0.5*0.9,-1*0.9],
-                                       [2*0.9,1.5*0.9,1*0.9,0.5*0.9,0,-0.5*0.9],
-                                       [2.5*0.9,2*0.9,1.5*0.9,1*0.9,0.5*0.9,0]])
-        
-        desired_distance_x = 0
-        desired_distance_neighbour_x = 0
-        desired_distance_neighbour_y= desired_distance_y[robot_id][m[0]]
-        
-        return desired_distance_neighbour_x, desired_distance_neighbour_y
+        return 0, LINE_Y[self.role(robot_id)][self.role(m[0])]
     
     def desired_distance_circle2(self,robot_id, m):
-        desired_circle2_x = np.array([[0,0.866,0.866,0,-0.866,-0.866],
-                                       [-0.866,0,0,-0.866,-0.866*2,-0.866*2],
-                                       [-0.866,0,0,-0.866,-0.866*2,-0.866*2],
-                                       [0,0.866,0.866,0,-0.866,-0.866],
-                                       [0.866,0.866*2,0.866*2,0.866,0,0],
-                                       [0.866,0.866*2,0.866*2,0.866,0,0]])
-        
-        desired_circle2_y = np.array([[0,0.5,1.5,2,1.5,0.5],
-                                       [-0.5,0,1,1.5,1,0],
-                                       [-1.5,-1,0,0.5,0,-1],
-                                       [-2,-1.5,-0.5,0,-0.5,-1.5],
-                                       [-1.5,-1,0,0.5,0,-1],
-                                       [-0.5,0,1,1.5,1,0]])
-        desired_circle2_neighbour_x = desired_circle2_x[m[0]][robot_id]
-        desired_circle2_neighbour_y= desired_circle2_y[m[0]][robot_id]
-        
-        return desired_circle2_neighbour_x, desired_circle2_neighbour_y
-  
-    
+        i, j = self.role(robot_id), self.role(m[0])
+        return CIRCLE2_X[j][i], CIRCLE2_Y[j][i]
     
     def desired_distance_circle1(self,robot_id,  m):
-        desired_circle1_x = np.array([[0,0.866*0.4,0.866*0.4,0,-0.866*0.4,-0.866*0.4],
-                                       [-0.866*0.4,0,0,-0.866*0.4,-0.866*2*0.4,-0.866*2*0.4],
-                                       [-0.866*0.4,0,0,-0.866*0.4,-0.866*2*0.4,-0.866*2*0.4],
-                                       [0,0.866*0.4,0.866*0.4,0,-0.866*0.4,-0.866*0.4],
-                                       [0.866*0.4,0.866*2*0.4,0.866*2*0.4,0.866*0.4,0,0],
-                                       [0.866*0.4,0.866*2*0.4,0.866*2*0.4,0.866*0.4,0,0]])
-        
-        desired_circle1_y = np.array([[0,0.5*0.4,1.5*0.4,2*0.4,1.5*0.4,0.5*0.4],
-                                       [-0.5*0.4,0,1*0.4,1.5*0.4,1*0.4,0],
-                                       [-1.5*0.4,-1*0.4,0,0.5*0.4,0,-1*0.4],
-                                       [-2*0.4,-1.5*0.4,-0.5*0.4,0,-0.5*0.4,-1.5*0.4],
-                                       [-1.5*0.4,-1*0.4,0,0.5*0.4,0,-1*0.4],
-                                       [-0.5*0.4,0,1*0.4,1.5*0.4,1*0.4,0]])
-        desired_circle1_neighbour_x = desired_circle1_x[m[0]][robot_id]
-        desired_circle1_neighbour_y= desired_circle1_y[m[0]][robot_id]
-        
-        return desired_circle1_neighbour_x, desired_circle1_neighbour_y
+        i, j = self.role(robot_id), self.role(m[0])
+        return CIRCLE1_X[j][i], CIRCLE1_Y[j][i]
+
     def desired_distance_line2(self,robot_id,  m):
-        desired_distance2_y = np.array([[0,-0.5*0.9,-1*0.9,-1.5*0.9,-2*0.9,-2.5*0.9],
-                                       [0.5*0.9,0,-0.5*0.9,-1*0.9,-1.5*0.9,-2*0.9],
-                                       [1*0.9,0.5*0.9,0,-0.5*0.9,-1*0.9,-1.5*0.9],
-                                       [1.5*0.9,1*0.9,0.5*0.9,0,-0.5*0.9,-1*0.9],
-                                       [2*0.9,1.5*0.9,1*0.9,0.5*0.9,0,-0.5*0.9],
-                                       [2.5*0.9,2*0.9,1.5*0.9,1*0.9,0.5*0.9,0]])
-        
-        desired_distance2_x = 0
-        desired_distance2_neighbour_x = 0
-        desired_distance2_neighbour_y= desired_distance2_y[m[0]][robot_id]
-        
-        return desired_distance2_neighbour_x, desired_distance2_neighbour_y
+        return 0, LINE_Y[self.role(m[0])][self.role(robot_id)]
+
     def diamond(self,robot_id,  m):
-        diamond_x=np.array([[0,0.5*0.9,0,-0.5*0.9,-0.5*0.9,-0.5*0.9],
-                            [-0.5*0.9,0,-0.5*0.9,-1*0.9,-1*0.9,-1*0.9],
-                            [0,0.5*0.9,0,-0.5*0.9,-0.5*0.9,-0.5*0.9],
-                            [0.5*0.9,1*0.9,0.5*0.9,0,0,0],
-                            [0.5*0.9,1*0.9,0.5*0.9,0,0,0],
-                            [0.5*0.9,1*0.9,0.5*0.9,0,0,0]])
-        diamond_y=np.array([[0,1*0.9,2*0.9,1.5*0.9,1*0.9,0.5*0.9],
-                            [-1*0.9,0,1*0.9,0.5*0.9,0,-0.5*0.9],
-                            [-2*0.9,-1*0.9,0,-0.5*0.9,-1*0.9,-1.5*0.9],
-                            [-1.5*0.9,-0.5*0.9,0.5*0.9,0,-0.5*0.9,-1*0.9],
-                            [-1*0.9,0,1*0.9,0.5*0.9,0,-0.5*0.9],
-                            [-0.5*0.9,0.5*0.9,1.5*0.9,1*0.9,0.5*0.9,0]])
-        diamond_x = diamond_x[m[0]][robot_id]
-        diamond_y= diamond_y[m[0]][robot_id]
-        
-        return diamond_x, diamond_y
+        i, j = self.role(robot_id), self.role(m[0])
+        return DIAMOND_X[j][i], DIAMOND_Y[j][i]
+
+    def toward(self, pos, target):
+        """
+        Returns the displacement (dx, dy) from pos to target. With a navigator, it points along
+        the shortest path around the walls and its length is the length of that path.
+        """
+        if self.navigator is None:
+            return - pos[0] + target[0], - pos[1] + target[1]
+        direction, distance = self.navigator.direction(pos, target)
+        return direction[0] * distance, direction[1] * distance
+
+    def drive(self, dx, dy, rot, gain):
+        """
+        Turns a desired displacement (dx, dy) into wheel velocities and applies them,
+        rot is the current yaw of the robot. gain scales the wheel speed, controller_mode selects the law:
+        - consensus: wheel speeds proportional to the displacement (the original law)
+        - scheduled: same law, but the gain is raised when the displacement gets small so
+          the robots do not crawl towards their final position
+        - turn_drive: turns on the spot until facing the target, then drives with the scheduled speed
+        """
+        vel_norm = np.linalg.norm([dx, dy]) #norm of desired velocity
+        if vel_norm < 0.01:
+            vel_norm = 0.01
+        des_theta = np.arctan2(dy/vel_norm, dx/vel_norm)
+
+        if self.controller_mode == "consensus":
+            right_wheel = gain*np.sin(des_theta-rot)*vel_norm + gain*np.cos(des_theta-rot)*vel_norm
+            left_wheel = -gain*np.sin(des_theta-rot)*vel_norm + gain*np.cos(des_theta-rot)*vel_norm
+            self.set_wheel_velocity([left_wheel, right_wheel])
+            return
+
+        boost = min(self.max_gain_boost, max(1., self.error_reference / vel_norm))
+        speed = gain * boost * vel_norm
+        if self.controller_mode == "scheduled":
+            right_wheel = speed * (np.sin(des_theta-rot) + np.cos(des_theta-rot))
+            left_wheel = speed * (-np.sin(des_theta-rot) + np.cos(des_theta-rot))
+        elif self.controller_mode == "turn_drive":
+            heading_error = np.arctan2(np.sin(des_theta-rot), np.cos(des_theta-rot))
+            turn = self.turn_gain * heading_error
+            if abs(heading_error) > self.turn_threshold:
+                speed = 0.
+            right_wheel = speed * np.cos(heading_error) + turn
+            left_wheel = speed * np.cos(heading_error) - turn
+        else:
+            raise ValueError("unknown controller mode %s" % self.controller_mode)
+        self.set_wheel_velocity(np.clip([left_wheel, right_wheel], -self.max_wheel_speed, self.max_wheel_speed))
+
     def compute_controller(self):
         """ 
         function that will be called each control cycle which implements the control law
@@ -187,13 +480,14 @@ class Robot():
         if self.state == 0:
             if self.id == 5 :
                   if messages:
+                    to_x, to_y = self.toward(pos, WAYPOINTS[self.state])
                     for m in messages:
                         
                         desired_distance_neighbour_x, desired_distance_neighbour_y = self.desired_distance_line(self.id, m)
 
 
-                        dx += - pos[0] + 2.5 
-                        dy += - pos[1] + 10
+                        dx += to_x
+                        dy += to_y
 
             #             # integrate?what is this used for?
             #             des_pos_x = pos[0] + self.dt * dx
@@ -201,13 +495,7 @@ class Robot():
 
 
                     #computem and make a circle formation outside velocity change for the wheels
-                    vel_norm = np.linalg.norm([dx, dy]) #norm of desired velocity
-                    if vel_norm < 0.01:
-                        vel_norm = 0.01
-                    des_theta = np.arctan2(dy/vel_norm, dx/vel_norm)
-                    right_wheel = 0.1*np.sin(des_theta-rot)*vel_norm + 0.1*np.cos(des_theta-rot)*vel_norm
-                    left_wheel = -0.1*np.sin(des_theta-rot)*vel_norm + 0.1*np.cos(des_theta-rot)*vel_norm
-                    self.set_wheel_velocity([left_wheel, right_wheel])
+                    self.drive(dx, dy, rot, 0.1)
 
                     erro_leader = 10 - pos[1]
                    
@@ -230,13 +518,7 @@ class Robot():
 
 
                     #compute velocity change for the wheels
-                    vel_norm = np.linalg.norm([dx, dy]) #norm of desired velocity
-                    if vel_norm < 0.01:
-                        vel_norm = 0.01
-                    des_theta = np.arctan2(dy/vel_norm, dx/vel_norm)
-                    right_wheel = 11*np.sin(des_theta-rot)*vel_norm + 11*np.cos(des_theta-rot)*vel_norm
-                    left_wheel = -11*np.sin(des_theta-rot)*vel_norm + 11*np.cos(des_theta-rot)*vel_norm
-                    self.set_wheel_velocity([left_wheel, right_wheel])
+                    self.drive(dx, dy, rot, 11)
      #circle2 formation              
                   
         elif self.state == 1:
@@ -262,26 +544,21 @@ class Robot():
 
 
                     #compute velocity change for the wheels
-                    vel_norm = np.linalg.norm([dx, dy]) #norm of desired velocity
-                    if vel_norm < 0.01:
-                        vel_norm = 0.01
-                    des_theta = np.arctan2(dy/vel_norm, dx/vel_norm)
-                    right_wheel = 5*np.sin(des_theta-rot)*vel_norm + 5*np.cos(des_theta-rot)*vel_norm
-                    left_wheel = -5*np.sin(des_theta-rot)*vel_norm + 5*np.cos(des_theta-rot)*vel_norm
-                    self.set_wheel_velocity([left_wheel, right_wheel])
+                    self.drive(dx, dy, rot, 5)
                     
    #circle2 moving follow leader 0            
         elif self.state == 2:
             
             if self.id == 0 :
                   if messages:
+                    to_x, to_y = self.toward(pos, WAYPOINTS[self.state])
                     for m in messages:
                         
 #                         desired_distance_neighbour_x, desired_distance_neighbour_y = self.desired_distance_line(self.id, m)
 
 
-                        dx += - pos[0] + 2.5 
-                        dy += - pos[1] + 3
+                        dx += to_x
+                        dy += to_y
 
             #             # integrate?what is this used for?
             #             des_pos_x = pos[0] + self.dt * dx
@@ -289,13 +566,7 @@ class Robot():
 
 
                     #computem and make a circle formation outside velocity change for the wheels
-                    vel_norm = np.linalg.norm([dx, dy]) #norm of desired velocity
-                    if vel_norm < 0.01:
-                        vel_norm = 0.01
-                    des_theta = np.arctan2(dy/vel_norm, dx/vel_norm)
-                    right_wheel = 0.8*np.sin(des_theta-rot)*vel_norm + 0.8*np.cos(des_theta-rot)*vel_norm
-                    left_wheel = -0.8*np.sin(des_theta-rot)*vel_norm + 0.8*np.cos(des_theta-rot)*vel_norm
-                    self.set_wheel_velocity([left_wheel, right_wheel])
+                    self.drive(dx, dy, rot, 0.8)
 
                     erro_leader = pos[1]-3
                     
@@ -319,13 +590,7 @@ class Robot():
 
 
                     #compute velocity change for the wheels
-                    vel_norm = np.linalg.norm([dx, dy]) #norm of desired velocity
-                    if vel_norm < 0.01:
-                        vel_norm = 0.01
-                    des_theta = np.arctan2(dy/vel_norm, dx/vel_norm)
-                    right_wheel = 8*np.sin(des_theta-rot)*vel_norm + 8*np.cos(des_theta-rot)*vel_norm
-                    left_wheel = -8*np.sin(des_theta-rot)*vel_norm + 8*np.cos(des_theta-rot)*vel_norm
-                    self.set_wheel_velocity([left_wheel, right_wheel])
+                    self.drive(dx, dy, rot, 8)
 
                     
 #move ball to purple follow leader 0
@@ -333,13 +598,14 @@ class Robot():
             
             if self.id == 0 :
                   if messages:
+                    to_x, to_y = self.toward(pos, WAYPOINTS[self.state])
                     for m in messages:
                         
 #                         desired_distance_neighbour_x, desired_distance_neighbour_y = self.desired_distance_line(self.id, m)
 
 
-                        dx += - pos[0] + 2.4 
-                        dy += - pos[1] + 6
+                        dx += to_x
+                        dy += to_y
 
             #             # integrate?what is this used for?
             #             des_pos_x = pos[0] + self.dt * dx
@@ -347,13 +613,7 @@ class Robot():
 
 
                     #computem and make a circle formation outside velocity change for the wheels
-                    vel_norm = np.linalg.norm([dx, dy]) #norm of desired velocity
-                    if vel_norm < 0.01:
-                        vel_norm = 0.01
-                    des_theta = np.arctan2(dy/vel_norm, dx/vel_norm)
-                    right_wheel = 0.1*np.sin(des_theta-rot)*vel_norm + 0.1*np.cos(des_theta-rot)*vel_norm
-                    left_wheel = -0.1*np.sin(des_theta-rot)*vel_norm + 0.1*np.cos(des_theta-rot)*vel_norm
-                    self.set_wheel_velocity([left_wheel, right_wheel])
+                    self.drive(dx, dy, rot, 0.1)
 
                     erro_leader = 6-pos[1]
                     
@@ -377,13 +637,7 @@ class Robot():
 
 
                     #compute velocity change for the wheels
-                    vel_norm = np.linalg.norm([dx, dy]) #norm of desired velocity
-                    if vel_norm < 0.01:
-                        vel_norm = 0.01
-                    des_theta = np.arctan2(dy/vel_norm, dx/vel_norm)
-                    right_wheel = 8*np.sin(des_theta-rot)*vel_norm +8*np.cos(des_theta-rot)*vel_norm
-                    left_wheel = -8*np.sin(des_theta-rot)*vel_norm + 8*np.cos(des_theta-rot)*vel_norm
-                    self.set_wheel_velocity([left_wheel, right_wheel])
+                    self.drive(dx, dy, rot, 8)
                     
        #circle2 formation              
                   
@@ -417,10 +671,11 @@ class Robot():
             
             if self.id == 1 :
                   if messages:
+                    to_x, to_y = self.toward(pos, WAYPOINTS[self.state])
                     for m in messages:
 
-                        dx += - pos[0] + 6.1
-                        dy += - pos[1] + 4.9
+                        dx += to_x
+                        dy += to_y
 
             #             # integrate?what is this used for?
             #             des_pos_x = pos[0] + self.dt * dx
@@ -428,13 +683,7 @@ class Robot():
 
 
                     #computem and make a circle formation outside velocity change for the wheels
-                    vel_norm = np.linalg.norm([dx, dy]) #norm of desired velocity
-                    if vel_norm < 0.01:
-                        vel_norm = 0.01
-                    des_theta = np.arctan2(dy/vel_norm, dx/vel_norm)
-                    right_wheel = 0.1*np.sin(des_theta-rot)*vel_norm + 0.1*np.cos(des_theta-rot)*vel_norm
-                    left_wheel = -0.1*np.sin(des_theta-rot)*vel_norm + 0.1*np.cos(des_theta-rot)*vel_norm
-                    self.set_wheel_velocity([left_wheel, right_wheel])
+                    self.drive(dx, dy, rot, 0.1)
 
                     erro_leader = 6.1-pos[0]
    
@@ -457,13 +706,7 @@ class Robot():
 
 
                     #compute velocity change for the wheels
-                    vel_norm = np.linalg.norm([dx, dy]) #norm of desired velocity
-                    if vel_norm < 0.01:
-                        vel_norm = 0.01
-                    des_theta = np.arctan2(dy/vel_norm, dx/vel_norm)
-                    right_wheel = 5*np.sin(des_theta-rot)*vel_norm + 5*np.cos(des_theta-rot)*vel_norm
-                    left_wheel = -5*np.sin(des_theta-rot)*vel_norm + 5*np.cos(des_theta-rot)*vel_norm
-                    self.set_wheel_velocity([left_wheel, right_wheel])
+                    self.drive(dx, dy, rot, 5)
                     
                     
                     
@@ -473,13 +716,14 @@ class Robot():
             
             if self.id == 0 :
                   if messages:
+                    to_x, to_y = self.toward(pos, WAYPOINTS[self.state])
                     for m in messages:
                         
 #                         desired_distance_neighbour_x, desired_distance_neighbour_y = self.desired_distance_line(self.id, m)
 
 
-                        dx += - pos[0] + 4.5 
-                        dy += - pos[1] + 0 
+                        dx += to_x
+                        dy += to_y
 
             #             # integrate?what is this used for?
             #             des_pos_x = pos[0] + self.dt * dx
@@ -487,13 +731,7 @@ class Robot():
 
 
                     #computem and make a circle formation outside velocity change for the wheels
-                    vel_norm = np.linalg.norm([dx, dy]) #norm of desired velocity
-                    if vel_norm < 0.01:
-                        vel_norm = 0.01
-                    des_theta = np.arctan2(dy/vel_norm, dx/vel_norm)
-                    right_wheel = 0.5*np.sin(des_theta-rot)*vel_norm + 0.5*np.cos(des_theta-rot)*vel_norm
-                    left_wheel = -0.5*np.sin(des_theta-rot)*vel_norm + 0.5*np.cos(des_theta-rot)*vel_norm
-                    self.set_wheel_velocity([left_wheel, right_wheel])
+                    self.drive(dx, dy, rot, 0.5)
 
                     erro_leader = pos[1]
    
@@ -518,13 +756,7 @@ class Robot():
 
 
                     #compute velocity change for the wheels
-                    vel_norm = np.linalg.norm([dx, dy]) #norm of desired velocity
-                    if vel_norm < 0.01:
-                        vel_norm = 0.01
-                    des_theta = np.arctan2(dy/vel_norm, dx/vel_norm)
-                    right_wheel = 11*np.sin(des_theta-rot)*vel_norm + 11*np.cos(des_theta-rot)*vel_norm
-                    left_wheel = -11*np.sin(des_theta-rot)*vel_norm + 11*np.cos(des_theta-rot)*vel_norm
-                    self.set_wheel_velocity([left_wheel, right_wheel])
+                    self.drive(dx, dy, rot, 11)
                     
                    
                     
@@ -533,13 +765,14 @@ class Robot():
             
             if self.id == 3 :
                   if messages:
+                    to_x, to_y = self.toward(pos, WAYPOINTS[self.state])
                     for m in messages:
                         
 #                         desired_distance_neighbour_x, desired_distance_neighbour_y = self.desired_distance_line(self.id, m)
 
 
-                        dx += - pos[0] + 0.2
-                        dy += - pos[1] + 6
+                        dx += to_x
+                        dy += to_y
 
             #             # integrate?what is this used for?
             #             des_pos_x = pos[0] + self.dt * dx
@@ -547,13 +780,7 @@ class Robot():
 
 
                     #computem and make a circle formation outside velocity change for the wheels
-                    vel_norm = np.linalg.norm([dx, dy]) #norm of desired velocity
-                    if vel_norm < 0.01:
-                        vel_norm = 0.01
-                    des_theta = np.arctan2(dy/vel_norm, dx/vel_norm)
-                    right_wheel = 0.2*np.sin(des_theta-rot)*vel_norm + 0.2*np.cos(des_theta-rot)*vel_norm
-                    left_wheel = -0.2*np.sin(des_theta-rot)*vel_norm + 0.2*np.cos(des_theta-rot)*vel_norm
-                    self.set_wheel_velocity([left_wheel, right_wheel])
+                    self.drive(dx, dy, rot, 0.2)
 
                     erro_leader = (6-pos[1])*(6-pos[1])
                     
@@ -577,13 +804,7 @@ class Robot():
 
 
                     #compute velocity change for the wheels
-                    vel_norm = np.linalg.norm([dx, dy]) #norm of desired velocity
-                    if vel_norm < 0.01:
-                        vel_norm = 0.01
-                    des_theta = np.arctan2(dy/vel_norm, dx/vel_norm)
-                    right_wheel = 8*np.sin(des_theta-rot)*vel_norm +8*np.cos(des_theta-rot)*vel_norm
-                    left_wheel = -8*np.sin(des_theta-rot)*vel_norm + 8*np.cos(des_theta-rot)*vel_norm
-                    self.set_wheel_velocity([left_wheel, right_wheel]) 
+                    self.drive(dx, dy, rot, 8)
                     
                     
 
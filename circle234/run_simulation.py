@@ -1,4 +1,5 @@
 # import libraries
+import argparse
 import numpy as np
 import pybullet as p
 import itertools
@@ -6,16 +7,23 @@ from time import sleep
 
 # the main class to do the simulation
 from swarm_simulation import World
+from render_budget import RenderBudget
 
+parser = argparse.ArgumentParser()
+parser.add_argument("--speed", type=float, default=1.0,
+                    help="simulated seconds per wall second, 0 to run as fast as possible")
+parser.add_argument("--fps", type=float, default=30., help="frames shown per wall second")
+args = parser.parse_args()
 
 # the main control loop
 
 #initialize the simulation
 world = World()
+budget = RenderBudget(world, display_rate=args.fps, speed=args.speed or None)
 
 t = 0.
 counter = 0
 
 # starts a simulation
 while True:
-    world.stepSimulation()
+    budget.step()
@@ -0,0 +1,172 @@
+import ast
+import glob
+import hashlib
+import inspect
+import json
+import os
+import pickle
+
+import swarm_simulation
+from robot import controller_parameters
+
+# directory of the simulator modules, and the model files
+SOURCE_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+MODEL_FILES = "../models/*"
+
+
+def _file_digest(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 16), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def source_files(modules):
+    """
+    Returns the paths of the simulator modules whose content defines the scenario: the given
+    module names and every simulator module they import, directly or not
+    """
+    paths = set()
+    pending = list(modules)
+    while pending:
+        path = os.path.join(SOURCE_DIRECTORY, pending.pop().split(".")[0] + ".py")
+        if path in paths or not os.path.exists(path):
+            continue
+        paths.add(path)
+        with open(path) as f:
+            tree = ast.parse(f.read(), path)
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                pending += [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+                pending.append(node.module)
+    return sorted(paths)
+
+
+class ScenarioCache():
+    """
+    On-disk cache of converged scenario states, e.g. "swarm in circle2 formation at the first goal".
+    An entry is a pybullet .bullet file plus the rest of the episode snapshot of the world (swarm and
+    controller states, formation roles, mission events, time step, ..., see World.save_episode),
+    keyed by a hash of the scene, the robot count, the controller parameters and the target phase.
+    The cache keeps at most max_bytes on disk, evicting the least recently used entries.
+    """
+    def __init__(self, directory="scenario_cache", max_bytes=500 * 2**20):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def key(self, world, phase):
+        """
+        Returns the key of the scenario "world warmed up until phase"
+        """
+        # a change in any module used by the world, its robots or this cache invalidates the entries
+        # (by file, the robot class may live in the __main__ script)
+        robot = world.robots[0]
+        classes = [type(robot)] + ([type(robot.navigator)] if robot.navigator is not None else [])
+        modules = ["swarm_simulation", "scenario_cache"]
+        modules += [os.path.splitext(os.path.basename(inspect.getfile(c)))[0] for c in classes]
+        sources = dict((os.path.basename(path), _file_digest(path)) for path in source_files(modules))
+        models = dict((path, _file_digest(path)) for path in sorted(glob.glob(MODEL_FILES)))
+        description = {
+            "sources": sources,
+            "models": models,
+            "walls": swarm_simulation.WALL_POSES,
+            "balls": swarm_simulation.BALLS,
+            "initial_positions": [list(r.initial_position) for r in world.robots],
+            "robot_class": type(world.robots[0]).__name__,
+            "controller": controller_parameters(world.robots[0]),
+            "dt": world.dt,
+            "assignment": world.assignment,
+            "adaptive_step": world.adaptive_step,
+            "fidelity": world.fidelity,
+            "command_deadband": world.command_deadband,
+            "run_controllers": world.run_controllers,
+            "phase": phase,
+        }
+        return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+    def _paths(self, key):
+        base = os.path.join(self.directory, key)
+        return base + ".bullet", base + ".pkl"
+
+    def load(self, key, world):
+        """
+        Restores the cached scenario into world (which must have been built the same way),
+        returns False if the scenario is not cached
+        """
+        bullet, state = self._paths(key)
+        if not (os.path.exists(bullet) and os.path.exists(state)):
+            return False
+        with open(state, "rb") as f:
+            snapshot = pickle.load(f)
+        world.restore_episode(snapshot, bullet_file=bullet)
+        # mark as recently used
+        os.utime(state, None)
+        return True
+
+    def store(self, key, world):
+        """
+        Saves the current state of world under key, then evicts old entries if needed
+        """
+        bullet, state = self._paths(key)
+        # write to temporary files first so that a concurrent reader never sees half an entry
+        snapshot = world.save_episode(bullet_file=bullet + ".tmp")
+        with open(state + ".tmp", "wb") as f:
+            pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(bullet + ".tmp", bullet)
+        os.replace(state + ".tmp", state)
+        self.evict()
+
+    def entries(self):
+        """
+        Returns the cached entries as (last use, size in bytes, key), least recently used first
+        """
+        entries = []
+        for state in glob.glob(os.path.join(self.directory, "*.pkl")):
+            key = os.path.basename(state)[:-len(".pkl")]
+            bullet, _ = self._paths(key)
+            size = os.path.getsize(state)
+            if os.path.exists(bullet):
+                size += os.path.getsize(bullet)
+            entries.append((os.path.getmtime(state), size, key))
+        return sorted(entries)
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in entries:
+            if total <= self.max_bytes:
+                break
+            self.remove(key)
+            total -= size
+
+    def remove(self, key):
+        for path in self._paths(key):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def clear(self):
+        for _, _, key in self.entries():
+            self.remove(key)
+
+
+def warm_start(world, phase, cache=None, max_time=300.):
+    """
+    Brings a freshly built world to the point where every robot has entered the mission
+    state phase, loading it from the cache when possible instead of simulating it.
+    Returns True on a cache hit.
+    """
+    if cache is None:
+        cache = ScenarioCache()
+    key = cache.key(world, phase)
+    if cache.load(key, world):
+        return True
+    while min(r.state for r in world.robots) < phase:
+        if world.time > max_time:
+            raise RuntimeError("phase %d not reached after %.0f s of simulation" % (phase, max_time))
+        world.stepSimulation()
+    cache.store(key, world)
+    return False
@@ -0,0 +1,73 @@
+import pickle
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+class SharedMailbox():
+    """
+    Fixed size slots in shared memory, each holding one pickled object.
+    Used to pass messages (and other small python objects) between processes
+    without going through pipes: one process writes a slot, the others read it
+    after synchronizing on a barrier.
+    """
+    HEADER = 8
+
+    def __init__(self, n_slots, slot_size=4096, name=None):
+        self.n_slots = n_slots
+        self.slot_size = slot_size
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=n_slots * slot_size)
+            self.owner = True
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            self.owner = False
+        self.lengths = np.ndarray((n_slots,), dtype=np.int64, buffer=self.shm.buf,
+                                  offset=0, strides=(slot_size,))
+        if self.owner:
+            self.lengths[:] = 0
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def spec(self):
+        """
+        Returns the arguments needed to attach to this mailbox from another process
+        """
+        return (self.n_slots, self.slot_size, self.name)
+
+    def put(self, slot, obj):
+        """
+        Pickles obj into the given slot, an empty slot is written for None
+        """
+        if obj is None:
+            self.lengths[slot] = 0
+            return
+        data = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(data) > self.slot_size - self.HEADER:
+            raise ValueError("message of %d bytes does not fit in a slot of %d bytes"
+                             % (len(data), self.slot_size - self.HEADER))
+        start = slot * self.slot_size + self.HEADER
+        self.shm.buf[start:start + len(data)] = data
+        self.lengths[slot] = len(data)
+
+    def get(self, slot):
+        """
+        Returns the object stored in the slot, or None if the slot is empty
+        """
+        length = int(self.lengths[slot])
+        if length == 0:
+            return None
+        start = slot * self.slot_size + self.HEADER
+        return pickle.loads(self.shm.buf[start:start + length])
+
+    def clear(self):
+        self.lengths[:] = 0
+
+    def close(self):
+        # the numpy view must be released before the buffer can be closed
+        del self.lengths
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
@@ -2,134 +2,486 @@ import numpy as np
 import pybullet as p
 import itertools
 
-from robot import Robot
+from assignment import formation_roles
+from mission_events import MissionEvents
+from robot import CONTACT_PHASES, WAYPOINTS, Robot, forget_shapes
+from swarm_state import SwarmState
+    
+# poses (position, orientation) of the walls.sdf instances making up the arena
+WALL_POSES = [
+    ([0., -1., 0], (0., 0., 0.5, 0.5)),
+    ([0., 1., 0], (0., 0., 0.5, 0.5)),
+    ([3., -1., 0], (0., 0., 0.5, 0.5)),
+    ([3., 1., 0], (0., 0., 0.5, 0.5)),
+    ([1., 2., 0], (0., 0., 0., 1.)),
+    ([2., -2., 0], (0., 0., 0., 1.)),
+]
+
+# the balls to push, as (urdf file, position, orientation)
+BALLS = [
+    ("../models/ball1.urdf", [2., 4., 0.5], (0., 0., 0.5, 0.5)),
+    ("../models/ball2.urdf", [4., 2., 0.5], (0., 0., 0.5, 0.5)),
+]
+
+# mission state in which the swarm pushes each ball of BALLS, its goal is the one at the
+# waypoint of that state
+BALL_PHASES = [3, 6]
+
+# initial positions of the 6 robots, indexed by robot id
+INITIAL_POSITIONS = [[1. * i + 0.5, 1. * j - 0.5, 0.3] for (i,j) in itertools.product(range(3), range(2))]
+
+
+def load_static_scene(client=0, balls=False):
+    """
+    Loads the plane, the goals and the walls in the physics client client, with balls also the
+    balls of BALLS (before the walls: the loading order is the order of the bodies in the solver,
+    which changes the trajectories). Returns a dict with the pybullet ids of the loaded bodies.
+    """
+    planeId = p.loadURDF("../models/plane.urdf", physicsClientId=client)
+    p.changeDynamics(planeId, -1, lateralFriction=5., rollingFriction=0, physicsClientId=client)
+
+    goal_ids = [p.loadURDF("../models/goal.urdf", physicsClientId=client),
+                p.loadURDF("../models/goal2.urdf", physicsClientId=client)]
+
+    ball_ids = [load_ball(b, client) for b in range(len(BALLS))] if balls else []
+
+    wall_ids = []
+    for pos, orn in WALL_POSES:
+        wallId = p.loadSDF("../models/walls.sdf", physicsClientId=client)[0]
+        p.resetBasePositionAndOrientation(wallId, pos, orn, physicsClientId=client)
+        wall_ids.append(wallId)
+
+    # tube
+    # wallId = p.loadSDF("../models/walls.sdf")[0]
+    # p.resetBasePositionAndOrientation(wallId, [-1., 5., 0], (0., 0., 0., 1.))
+    # wallId = p.loadSDF("../models/walls.sdf")[0]
+    # p.resetBasePositionAndOrientation(wallId, [-1., 6., 0], (0., 0., 0., 1.))
+
+    # #arena
+    # wallId = p.loadSDF("../models/walls.sdf")[0]
+    # p.resetBasePositionAndOrientation(wallId, [-2, 4., 0], (0., 0., 0.5, 0.5))
+    # wallId = p.loadSDF("../models/walls.sdf")[0]
+    # p.resetBasePositionAndOrientation(wallId, [-2., 7., 0], (0., 0., 0.5, 0.5))
+    # wallId = p.loadSDF("../models/walls.sdf")[0]
+    # p.resetBasePositionAndOrientation(wallId, [-2., 9., 0], (0., 0., 0.5, 0.5))
+    # wallId = p.loadSDF("../models/walls.sdf")[0]
+    # p.resetBasePositionAndOrientation(wallId, [-2., 11., 0], (0., 0., 0.5, 0.5))
+    # wallId = p.loadSDF("../models/walls.sdf")[0]
+    # p.resetBasePositionAndOrientation(wallId, [-2., 13., 0], (0., 0., 0.5, 0.5))
+    # wallId = p.loadSDF("../models/walls.sdf")[0]
+    # p.resetBasePositionAndOrientation(wallId, [-3., 3., 0], (0., 0., 0., 1.))
+    # wallId = p.loadSDF("../models/walls.sdf")[0]
+    # p.resetBasePositionAndOrientation(wallId, [-5., 3., 0], (0., 0., 0., 1.))
+    # wallId = p.loadSDF("../models/walls.sdf")[0]
+    # p.resetBasePositionAndOrientation(wallId, [-7., 3., 0], (0., 0., 0., 1.))
+    # wallId = p.loadSDF("../models/walls.sdf")[0]
+    # p.resetBasePositionAndOrientation(wallId, [-8, 4., 0], (0., 0., 0.5, 0.5))
+    # wallId = p.loadSDF("../models/walls.sdf")[0]
+    # p.resetBasePositionAndOrientation(wallId, [-8., 6., 0], (0., 0., 0.5, 0.5))
+    # wallId = p.loadSDF("../models/walls.sdf")[0]
+    # p.resetBasePositionAndOrientation(wallId, [-8., 8., 0], (0., 0., 0.5, 0.5))
+    # wallId = p.loadSDF("../models/walls.sdf")[0]
+    # p.resetBasePositionAndOrientation(wallId, [-8., 10., 0], (0., 0., 0.5, 0.5))
+    # wallId = p.loadSDF("../models/walls.sdf")[0]
+    # p.resetBasePositionAndOrientation(wallId, [-8., 12., 0], (0., 0., 0.5, 0.5))
+
+    return {"plane": planeId, "goals": goal_ids, "balls": ball_ids, "walls": wall_ids}
+
+
+def load_ball(index, client=0):
+    """
+    Loads ball number index of BALLS at its initial pose and returns its pybullet id
+    """
+    urdf, pos, orn = BALLS[index]
+    ball = p.loadURDF(urdf, physicsClientId=client)
+    p.resetBasePositionAndOrientation(ball, pos, orn, physicsClientId=client)
+    return ball
+
     
 class World():
-    def __init__(self):
-        # create the physics simulator
-        self.physicsClient = p.connect(p.GUI)
-        p.setGravity(0,0,-9.81)
+    def __init__(self, gui=True, robot_class=Robot, assignment=None, adaptive_step=False, fidelity="full",
+                 run_controllers=True, command_deadband=0.):
+        # create the physics simulator (headless with gui=False)
+        self.physicsClient = p.connect(p.GUI if gui else p.DIRECT)
+        p.setGravity(0,0,-9.81, physicsClientId=self.physicsClient)
+
+        # with run_controllers=False the wheel commands come from outside (see control_server.py)
+        self.run_controllers = run_controllers
+
+        # the motors hold their target, so a wheel command within command_deadband (rad/s) of the
+        # one last sent to a robot is dropped (see flush_commands)
+        self.command_deadband = command_deadband
+        self.command_counts = {"sent": 0, "skipped": 0}
         
         self.max_communication_distance = 2.0
 
         # We will integrate every 4ms (250Hz update)
         self.dt = 1./250.
-        p.setPhysicsEngineParameter(self.dt, numSubSteps=1)
+        p.setPhysicsEngineParameter(self.dt, numSubSteps=1, physicsClientId=self.physicsClient)
 
-        # Create the plane.
-        self.planeId = p.loadURDF("../models/plane.urdf")
-        p.changeDynamics(self.planeId, -1, lateralFriction=5., rollingFriction=0)
+        # Create the plane, the goals, the balls and the walls.
+        scene = load_static_scene(self.physicsClient, balls=True)
+        self.planeId = scene["plane"]
+        self.goal_ids = scene["goals"]
+        self.goalId = self.goal_ids[-1]
+        self.wall_ids = scene["walls"]
+        self.ball1, self.ball2 = scene["balls"]
+        self.balls = [self.ball1, self.ball2]
+        # (x, y) of the balls, read after every step by sync_state, and half of their extent
+        self.ball_pos = np.zeros((len(self.balls), 2))
+        self.ball_half = np.zeros((len(self.balls), 2))
+        for b, ball in enumerate(self.balls):
+            low, high = p.getAABB(ball, physicsClientId=self.physicsClient)
+            self.ball_half[b] = (high[0] - low[0]) / 2., (high[1] - low[1]) / 2.
 
-        self.goalId = p.loadURDF("../models/goal.urdf")
-        self.goalId = p.loadURDF("../models/goal2.urdf")
-        
-        # the balls
-        self.ball1 = p.loadURDF("../models/ball1.urdf")
-        p.resetBasePositionAndOrientation(self.ball1, [2., 4., 0.5], (0., 0., 0.5, 0.5))
-        self.ball2 = p.loadURDF("../models/ball2.urdf")
-        p.resetBasePositionAndOrientation(self.ball2, [4., 2., 0.5], (0., 0., 0.5, 0.5))
-
-        p.resetDebugVisualizerCamera(7.0,90.0, -43.0, (1., 1., 0.0))
-        
-        # Add objects
-        wallId = p.loadSDF("../models/walls.sdf")[0]
-        p.resetBasePositionAndOrientation(wallId, [0., -1., 0], (0., 0., 0.5, 0.5))
-        wallId = p.loadSDF("../models/walls.sdf")[0]
-        p.resetBasePositionAndOrientation(wallId, [0., 1., 0], (0., 0., 0.5, 0.5))
-        wallId = p.loadSDF("../models/walls.sdf")[0]
-        p.resetBasePositionAndOrientation(wallId, [3., -1., 0], (0., 0., 0.5, 0.5))
-        wallId = p.loadSDF("../models/walls.sdf")[0]
-        p.resetBasePositionAndOrientation(wallId, [3., 1., 0], (0., 0., 0.5, 0.5))
-        wallId = p.loadSDF("../models/walls.sdf")[0]
-        p.resetBasePositionAndOrientation(wallId, [1., 2., 0], (0., 0., 0., 1.))
-        wallId = p.loadSDF("../models/walls.sdf")[0]
-        p.resetBasePositionAndOrientation(wallId, [2., -2., 0], (0., 0., 0., 1.))
-
-        # tube
-        # wallId = p.loadSDF("../models/walls.sdf")[0]
-        # p.resetBasePositionAndOrientation(wallId, [-1., 5., 0], (0., 0., 0., 1.))
-        # wallId = p.loadSDF("../models/walls.sdf")[0]
-        # p.resetBasePositionAndOrientation(wallId, [-1., 6., 0], (0., 0., 0., 1.))
-        
-        # #arena
-        # wallId = p.loadSDF("../models/walls.sdf")[0]
-        # p.resetBasePositionAndOrientation(wallId, [-2, 4., 0], (0., 0., 0.5, 0.5))
-        # wallId = p.loadSDF("../models/walls.sdf")[0]
-        # p.resetBasePositionAndOrientation(wallId, [-2., 7., 0], (0., 0., 0.5, 0.5))
-        # wallId = p.loadSDF("../models/walls.sdf")[0]
-        # p.resetBasePositionAndOrientation(wallId, [-2., 9., 0], (0., 0., 0.5, 0.5))
-        # wallId = p.loadSDF("../models/walls.sdf")[0]
-        # p.resetBasePositionAndOrientation(wallId, [-2., 11., 0], (0., 0., 0.5, 0.5))
-        # wallId = p.loadSDF("../models/walls.sdf")[0]
-        # p.resetBasePositionAndOrientation(wallId, [-2., 13., 0], (0., 0., 0.5, 0.5))
-        # wallId = p.loadSDF("../models/walls.sdf")[0]
-        # p.resetBasePositionAndOrientation(wallId, [-3., 3., 0], (0., 0., 0., 1.))
-        # wallId = p.loadSDF("../models/walls.sdf")[0]
-        # p.resetBasePositionAndOrientation(wallId, [-5., 3., 0], (0., 0., 0., 1.))
-        # wallId = p.loadSDF("../models/walls.sdf")[0]
-        # p.resetBasePositionAndOrientation(wallId, [-7., 3., 0], (0., 0., 0., 1.))
-        # wallId = p.loadSDF("../models/walls.sdf")[0]
-        # p.resetBasePositionAndOrientation(wallId, [-8, 4., 0], (0., 0., 0.5, 0.5))
-        # wallId = p.loadSDF("../models/walls.sdf")[0]
-        # p.resetBasePositionAndOrientation(wallId, [-8., 6., 0], (0., 0., 0.5, 0.5))
-        # wallId = p.loadSDF("../models/walls.sdf")[0]
-        # p.resetBasePositionAndOrientation(wallId, [-8., 8., 0], (0., 0., 0.5, 0.5))
-        # wallId = p.loadSDF("../models/walls.sdf")[0]
-        # p.resetBasePositionAndOrientation(wallId, [-8., 10., 0], (0., 0., 0.5, 0.5))
-        # wallId = p.loadSDF("../models/walls.sdf")[0]
-        # p.resetBasePositionAndOrientation(wallId, [-8., 12., 0], (0., 0., 0.5, 0.5))
+        p.resetDebugVisualizerCamera(7.0,90.0, -43.0, (1., 1., 0.0), physicsClientId=self.physicsClient)
 
-        
-        # create 6 robots
+        # create 6 robots, their state is kept in self.swarm
+        # fidelity is the model of the robots (see Robot.set_fidelity), "auto" lets update_fidelity choose
+        self.fidelity = fidelity
+        self.lod_margin = 0.5
+        self.swarm = SwarmState(len(INITIAL_POSITIONS), n_rays=robot_class.range_rays)
+        self.swarm.ranges.fill(robot_class.range_max)
+        n = self.swarm.n_robots
+        # scratch buffers of flush_commands
+        self._wheel_delta = np.empty((n, 2))
+        self._wheel_close = np.empty((n, 2), dtype=bool)
+        self._robot_close = np.empty(n, dtype=bool)
+        self._wheel_skipped = np.empty(n, dtype=bool)
         self.robots = []
-        for (i,j) in itertools.product(range(3), range(2)):
-            self.robots.append(Robot([1. * i + 0.5, 1. * j - 0.5, 0.3], 2*i+j, self.dt))
-            p.stepSimulation()
+        for i, init_pos in enumerate(INITIAL_POSITIONS):
+            self.robots.append(robot_class(init_pos, i, self.dt, self.swarm,
+                                           fidelity="full" if fidelity == "auto" else fidelity,
+                                           client=self.physicsClient))
+            p.stepSimulation(physicsClientId=self.physicsClient)
         
         self.time = 0.0
+        self.steps = 0
+        self.sync_state()
+
+        # directions of the range sensor rays relative to the heading of the robot
+        self.robot_class = robot_class
+        if robot_class.range_rays > 1:
+            self.ray_angles = np.linspace(robot_class.range_fov / 2., -robot_class.range_fov / 2., robot_class.range_rays)
+        else:
+            self.ray_angles = np.zeros(robot_class.range_rays)
+
+        # when set (see controller_pool.ControllerPool), the controllers run in worker processes
+        self.controller_pool = None
+
+        # with assignment ("sum" or "bottleneck", see assignment.formation_roles) the robots are
+        # assigned to the formation slots each time the formation changes, otherwise robot i holds slot i
+        self.assignment = assignment
+        self.phase = None
+        self.formation = None
+        self.update_formation()
+
+        # balls delivered to the goals, robots entering them, end of the mission
+        self.events = MissionEvents(self, targets=[WAYPOINTS[phase] for phase in BALL_PHASES])
+
+        # with adaptive_step, the physics integrates with steps coarse_factor times longer while
+        # no contact is expected (see near_contact), and the controllers run at the same rate
+        self.adaptive_step = adaptive_step
+        self.fine_dt = self.dt
+        self.coarse_factor = 4
+        self.contact_margin = 0.5
+        self.step_counts = {"fine": 0, "coarse": 0}
+        boxes = [p.getAABB(wall, link, physicsClientId=self.physicsClient) for wall in self.wall_ids
+                 for link in range(-1, p.getNumJoints(wall, physicsClientId=self.physicsClient))]
+        self.wall_boxes = np.array([[low[0], low[1], high[0], high[1]] for low, high in boxes]).reshape(-1, 4)
+        # the walls followed by the balls, and scratch buffers of contact_mask and pushing_mask
+        self.contact_boxes = np.concatenate([self.wall_boxes, np.zeros((len(self.balls), 4))])
+        self._expanded_boxes = np.empty_like(self.contact_boxes)
+        self._inside = np.empty((n, len(self.contact_boxes)), dtype=bool)
+        self._inside_test = np.empty_like(self._inside)
+        self._pushing = np.empty(n, dtype=bool)
+        self._pushing_test = np.empty(n, dtype=bool)
+        self._near = np.empty(n, dtype=bool)
+        self._far = np.empty(n, dtype=bool)
         
         self.stepSimulation()
         self.stepSimulation()
 
+        # snapshot of the initial scene, see reset()
+        self.initial_state = self.save_episode()
+
+    def save_episode(self, bullet_file=None):
+        """
+        Takes an in-memory snapshot of the whole simulation: pybullet bodies (robots, balls),
+        swarm state, controller states and clock. Returns it for restore_episode().
+        With bullet_file, the pybullet state is written to that file instead of kept in memory,
+        and the snapshot can be pickled (see scenario_cache.py).
+        """
+        if bullet_file is None:
+            bullet = p.saveState(physicsClientId=self.physicsClient)
+        else:
+            p.saveBullet(bullet_file, physicsClientId=self.physicsClient)
+            bullet = None
+        return {"bullet": bullet,
+                "swarm": self.swarm.save(),
+                "ball_pos": self.ball_pos.copy(),
+                "robots": [r.get_controller_state() for r in self.robots],
+                "time": self.time,
+                "steps": self.steps,
+                "phase": self.phase,
+                "formation": self.formation,
+                "events": self.events.save(),
+                "dt": self.dt,
+                "step_counts": dict(self.step_counts),
+                "command_counts": dict(self.command_counts),
+                "fidelity": [r.fidelity for r in self.robots],
+                "bodies": [r.pybullet_id for r in self.robots]}
+
+    def restore_episode(self, snapshot, bullet_file=None):
+        """
+        Puts the simulation back in the state of a snapshot taken by save_episode(),
+        bullet_file being the file given to save_episode() if any
+        """
+        for r, fidelity in zip(self.robots, snapshot["fidelity"]):
+            r.set_fidelity(fidelity)
+        if [r.pybullet_id for r in self.robots] != snapshot["bodies"]:
+            raise RuntimeError("the robot bodies changed since the snapshot was taken")
+        if bullet_file is None:
+            p.restoreState(snapshot["bullet"], physicsClientId=self.physicsClient)
+        else:
+            p.restoreState(fileName=bullet_file, physicsClientId=self.physicsClient)
+        self.swarm.restore(snapshot["swarm"])
+        self.ball_pos[...] = snapshot["ball_pos"]
+        for r, controller_state in zip(self.robots, snapshot["robots"]):
+            r.set_controller_state(controller_state)
+        self.time = snapshot["time"]
+        self.steps = snapshot["steps"]
+        self.phase = snapshot["phase"]
+        self.formation = snapshot["formation"]
+        self.events.restore(snapshot["events"])
+        self.set_time_step(snapshot["dt"])
+        self.step_counts = dict(snapshot["step_counts"])
+        self.command_counts = dict(snapshot["command_counts"])
+        # the motor targets are not part of the pybullet state, send them all again
+        self.swarm.wheel_dirty[:] = True
+        self.swarm.wheel_sent.fill(np.nan)
+
+    @property
+    def mission_complete(self):
+        """
+        True once every ball has been delivered to a goal
+        """
+        return self.events.complete
+
+    def close(self):
+        """
+        Disconnects from the physics simulator
+        """
+        if self.controller_pool is not None:
+            self.controller_pool.close()
+        p.disconnect(self.physicsClient)
+        forget_shapes(self.physicsClient)
+
     def reset(self):
         """
-        Resets the position of all the robots
+        Starts a new episode: restores the scene as it was at the end of __init__ (robots, balls,
+        mission states, messages, time) without loading anything again
         """
+        self.restore_episode(self.initial_state)
+
+    def sync_state(self):
+        """
+        Reads the poses of all the robots from pybullet into the swarm state.
+        Done after every simulation step, and needed after moving bodies by hand.
+        """
+        for r in self.robots:
+            r.update_pose()
+        for b, ball in enumerate(self.balls):
+            pos, _ = p.getBasePositionAndOrientation(ball, physicsClientId=self.physicsClient)
+            self.ball_pos[b] = pos[0], pos[1]
+
+    def sense_ranges(self):
+        """
+        Updates the range sensors of the whole swarm, with a single batch of ray casts
+        (split only if it exceeds the pybullet batch size)
+        """
+        swarm = self.swarm
+        rc = self.robot_class
+        angles = swarm.yaw[:, None] + self.ray_angles
+        directions = np.stack([np.cos(angles), np.sin(angles), np.zeros_like(angles)], axis=-1)
+        origins = swarm.pos[:, None, :]
+        starts = (origins + rc.range_offset * directions).reshape(-1, 3)
+        ends = (origins + rc.range_max * directions).reshape(-1, 3)
+
+        batch = getattr(p, "MAX_RAY_INTERSECTION_BATCH_SIZE", 16384)
+        fractions = np.empty(len(starts))
+        for i in range(0, len(starts), batch):
+            hits = p.rayTestBatch(starts[i:i + batch].tolist(), ends[i:i + batch].tolist(), numThreads=0,
+                                  physicsClientId=self.physicsClient)
+            fractions[i:i + len(hits)] = [h[2] for h in hits]
+        swarm.ranges[:] = (rc.range_offset + fractions * (rc.range_max - rc.range_offset)).reshape(swarm.ranges.shape)
+
+    def update_formation(self):
+        """
+        Reassigns the formation slots when the leading robot enters a phase with a new formation
+        """
+        phase = int(self.swarm.mission_state.max())
+        if phase == self.phase:
+            return
+        self.phase = phase
+        formation = self.robot_class.formation_for(phase)
+        if formation is None or formation == self.formation:
+            return
+        self.formation = formation
+        if self.assignment is not None:
+            self.swarm.role[:] = formation_roles(self.swarm.pos, formation, self.assignment)
+
+    def near_contact(self):
+        """
+        Whether contacts are expected soon: the swarm is pushing a ball, or a robot is
+        within contact_margin of a wall or a ball
+        """
+        if self.pushing_mask().any():
+            return True
+        return bool(self.contact_mask(self.contact_margin, out=self._near).any())
+
+    def pushing_mask(self):
+        """
+        For each robot, whether its mission state is one in which the swarm pushes a ball.
+        The result is overwritten by the next call.
+        """
+        pushing = self._pushing
+        pushing.fill(False)
+        for phase in CONTACT_PHASES:
+            np.equal(self.swarm.mission_state, phase, out=self._pushing_test)
+            pushing |= self._pushing_test
+        return pushing
+
+    def contact_mask(self, margin, out=None):
+        """
+        For each robot, whether it is within margin of a wall or a ball (written to out when given)
+        """
+        boxes = self.contact_boxes
+        n_walls = len(self.wall_boxes)
+        np.subtract(self.ball_pos, self.ball_half, out=boxes[n_walls:, :2])
+        np.add(self.ball_pos, self.ball_half, out=boxes[n_walls:, 2:])
+        expanded = self._expanded_boxes
+        np.subtract(boxes[:, :2], margin, out=expanded[:, :2])
+        np.add(boxes[:, 2:], margin, out=expanded[:, 2:])
+
+        x = self.swarm.pos[:, 0, None]
+        y = self.swarm.pos[:, 1, None]
+        inside = self._inside
+        test = self._inside_test
+        np.greater_equal(x, expanded[:, 0], out=inside)
+        np.less_equal(x, expanded[:, 2], out=test)
+        inside &= test
+        np.greater_equal(y, expanded[:, 1], out=test)
+        inside &= test
+        np.less_equal(y, expanded[:, 3], out=test)
+        inside &= test
+        return inside.any(axis=1, out=out)
+
+    def update_fidelity(self):
+        """
+        With fidelity "auto": the robots pushing a ball or within lod_margin of a wall or a ball
+        use the full model, the others the simple one. A robot goes back to the simple model
+        only once 1.5 lod_margin away, so that it does not switch at every step on the border.
+        """
+        pushing = self.pushing_mask()
+        near = self.contact_mask(self.lod_margin, out=self._near)
+        near |= pushing
+        # robots pushing or within 1.5 lod_margin, the others are far
+        not_far = self.contact_mask(1.5 * self.lod_margin, out=self._far)
+        not_far |= pushing
+        for r in self.robots:
+            if near[r.slot]:
+                r.set_fidelity("full")
+            elif not not_far[r.slot]:
+                r.set_fidelity("simple")
+
+    def set_time_step(self, dt):
+        """
+        Changes the physics time step, and the control period of the robots with it
+        """
+        if dt == self.dt:
+            return
+        self.dt = dt
+        p.setPhysicsEngineParameter(fixedTimeStep=dt, physicsClientId=self.physicsClient)
+        for r in self.robots:
+            r.dt = dt
+
+    @property
+    def steps_saved(self):
+        """
+        Number of physics steps avoided by the coarse steps
+        """
+        return self.step_counts["coarse"] * (self.coarse_factor - 1)
+
+    def flush_commands(self):
+        """
+        Sends the wheel velocities set by the controllers to pybullet. Only the commands that
+        moved by more than command_deadband from the last one sent go out, the ones dropped
+        are counted in command_counts["skipped"]. Simple robots get their base velocity every step.
+        """
+        swarm = self.swarm
+        # NaN (no target sent yet) never compares as close
+        delta = self._wheel_delta
+        np.subtract(swarm.wheel, swarm.wheel_sent, out=delta)
+        np.abs(delta, out=delta)
+        np.less_equal(delta, self.command_deadband, out=self._wheel_close)
+        close = self._wheel_close.all(axis=1, out=self._robot_close)
+        # only a command set since the last flush can be dropped, robots without one send nothing
+        skipped = np.logical_and(swarm.wheel_dirty, close, out=self._wheel_skipped)
+        np.logical_not(close, out=close)
+        swarm.wheel_dirty &= close
+        counts = self.command_counts
         for r in self.robots:
-            r.reset()
-        p.stepSimulation()
+            if r.fidelity == "simple":
+                r.apply_wheel_velocity()
+            elif swarm.wheel_dirty[r.slot]:
+                r.apply_wheel_velocity()
+                counts["sent"] += 1
+            elif skipped[r.slot]:
+                counts["skipped"] += 1
         
     def stepSimulation(self):
         """
         Simulates one step simulation
         """
-        
+        swarm = self.swarm
+        robots = self.robots
+
+        if self.fidelity == "auto":
+            self.update_fidelity()
+        if self.adaptive_step:
+            self.set_time_step(self.fine_dt if self.near_contact() else self.fine_dt * self.coarse_factor)
+        self.step_counts["fine" if self.dt == self.fine_dt else "coarse"] += 1
+
         # for each robot construct list of neighbors
-        for r in self.robots:
-            r.neighbors = [] #reset neighbors
-            r.messages_received = [] #reset message received
-            pos1, or1 = r.get_pos_and_orientation()
-            for j,r2 in enumerate(self.robots):
-                if(r.id != r2.id):
-                    pos2, or2 = r2.get_pos_and_orientation()
-                    if(np.linalg.norm(pos1-pos2) < self.max_communication_distance):
-                        r.neighbors.append(j)
+        swarm.update_neighbors(self.max_communication_distance)
+
+        if swarm.n_rays and self.steps % self.robot_class.range_period == 0:
+            self.sense_ranges()
         
         # for each robot send and receive messages
-        for i,r in enumerate(self.robots):
+        for r in robots:
+            r.messages_received.clear() #reset message received
+        for r in robots:
             for msg in r.messages_to_send:
-                if msg[0] in r.neighbors: #then we can send the message
-                    self.robots[msg[0]].messages_received.append([i, msg[1]]) #add the sender id
-            r.messages_to_send = []
+                if swarm.neighbors[r.slot, msg[0]]: #then we can send the message
+                    robots[msg[0]].messages_received.append((r.id, msg[1])) #add the sender id
+            r.messages_to_send.clear()
         
         # update the controllers
-        state =0
-        if self.time > 1.0:
-            
-            for r in self.robots:
-                r.compute_controller()
+        if self.time > 1.0 and self.run_controllers:
+            if self.controller_pool is not None:
+                self.controller_pool.compute(robots)
+            else:
+                for r in robots:
+                    r.compute_controller()
         
         # do one simulation step
-        p.stepSimulation()
+        self.flush_commands()
+        p.stepSimulation(physicsClientId=self.physicsClient)
         self.time += self.dt
+        self.steps += 1
+        self.sync_state()
+        self.update_formation()
+        self.events.update()
         
@@ -0,0 +1,105 @@
+import numpy as np
+
+
+class SwarmState():
+    """
+    Preallocated arrays holding the state of every robot of a swarm, indexed by robot slot.
+    Robot objects are thin views on a row of these arrays, so the world can update the
+    whole swarm every tick without creating new python objects.
+    """
+    def __init__(self, n_robots, buffer=None, n_rays=0):
+        """
+        The arrays are allocated in buffer when given (e.g. the buf of a shared memory
+        block of at least SwarmState.nbytes(n_robots, n_rays) bytes), so that several processes can share them.
+        n_rays is the number of rays of the range sensor of each robot.
+        """
+        self.n_robots = n_robots
+        self.n_rays = n_rays
+        for name, shape, dtype, offset in self._layout(n_robots, n_rays):
+            if buffer is None:
+                array = np.zeros(shape, dtype=dtype)
+            else:
+                array = np.ndarray(shape, dtype=dtype, buffer=buffer, offset=offset)
+            setattr(self, name, array)
+        if buffer is None:
+            self.role[:] = np.arange(n_robots)
+            self.wheel_sent.fill(np.nan)
+
+        # scratch buffers for update_neighbors, allocated on first use
+        self._delta = None
+        self._dist2 = None
+
+    @staticmethod
+    def _layout(n, n_rays=0):
+        fields = [
+            ("pos", (n, 3), np.float64),
+            ("yaw", (n,), np.float64),
+            ("mission_state", (n,), np.int64),
+            # last wheel velocities requested by the controllers, and whether they still have to be sent
+            ("wheel", (n, 2), np.float64),
+            ("wheel_dirty", (n,), np.bool_),
+            # last wheel velocities sent to the motors (NaN when the motors have no known target)
+            ("wheel_sent", (n, 2), np.float64),
+            # neighbors[i, j] is True when robot j is within communication distance of robot i
+            ("neighbors", (n, n), np.bool_),
+            # slot of each robot in the current formation, see assignment.formation_roles
+            ("role", (n,), np.int64),
+            # last reading of the range sensors, distance along each ray (range_max when nothing is hit)
+            ("ranges", (n, n_rays), np.float64),
+        ]
+        layout = []
+        offset = 0
+        for name, shape, dtype in fields:
+            layout.append((name, shape, dtype, offset))
+            size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+            offset += (size + 7) // 8 * 8
+        return layout
+
+    @classmethod
+    def nbytes(cls, n_robots, n_rays=0):
+        """
+        Size of the buffer needed to hold the state of n_robots
+        """
+        name, shape, dtype, offset = cls._layout(n_robots, n_rays)[-1]
+        return offset + int(np.prod(shape)) * np.dtype(dtype).itemsize
+
+    def save(self):
+        """
+        Returns a copy of all the arrays, to be given to restore()
+        """
+        return dict((name, getattr(self, name).copy()) for name, _, _, _ in self._layout(self.n_robots, self.n_rays))
+
+    def restore(self, saved):
+        """
+        Copies back arrays returned by save(), in place
+        """
+        for name, array in saved.items():
+            getattr(self, name)[...] = array
+
+    def update_neighbors(self, max_distance, rows=None):
+        """
+        Recomputes the neighbor mask from the current positions. With rows, only the
+        rows of these robots are updated (used when only a few robots are simulated locally).
+        """
+        if rows is not None:
+            for i in rows:
+                delta = self.pos - self.pos[i]
+                np.less(np.einsum('ij,ij->i', delta, delta), max_distance * max_distance, out=self.neighbors[i])
+                self.neighbors[i, i] = False
+            return
+
+        if self._delta is None:
+            n = self.n_robots
+            self._delta = np.zeros((n, n))
+            self._dist2 = np.zeros((n, n))
+            # views reused every call: the coordinates as column and row, and the diagonal
+            self._coordinates = [(self.pos[:, k, None], self.pos[None, :, k]) for k in range(3)]
+            self._dist2_diagonal = self._dist2.reshape(-1)[::n + 1]
+        self._dist2.fill(0.)
+        for column, row in self._coordinates:
+            np.subtract(column, row, out=self._delta)
+            np.multiply(self._delta, self._delta, out=self._delta)
+            np.add(self._dist2, self._delta, out=self._dist2)
+        # a robot is not its own neighbor
+        self._dist2_diagonal.fill(np.inf)
+        np.less(self._dist2, max_distance * max_distance, out=self.neighbors)
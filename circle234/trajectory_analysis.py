@@ -0,0 +1,170 @@
+# Chunked analysis of trajectory logs recorded with trajectory_log.TrajectoryRecorder.
+# The logs are memory-mapped and processed a block of ticks at a time, so memory use does
+# not depend on the length of the run. Independent runs are analyzed in parallel.
+#
+#   python trajectory_analysis.py runs/* --out summary.csv
+import argparse
+import csv
+import multiprocessing
+import os
+
+import numpy as np
+
+from robot import FORMATION_SLOTS, PHASE_FORMATIONS, formation_error
+from trajectory_log import open_run
+
+
+def _connected(masks, n):
+    """
+    For each row of neighbor bitmasks (ticks, n), whether the communication graph is connected
+    """
+    bits = np.arange(n, dtype=np.uint64)
+    reach = np.ones(len(masks), dtype=np.uint64)  # start from robot 0
+    for _ in range(n - 1):
+        members = ((reach[:, None] >> bits) & np.uint64(1)).astype(bool)
+        grown = reach | np.bitwise_or.reduce(np.where(members, masks, np.uint64(0)), axis=1)
+        if (grown == reach).all():
+            break
+        reach = grown
+    return reach == np.uint64((1 << n) - 1)
+
+
+def analyze_run(directory, chunk_ticks=20000):
+    """
+    Analyzes one recorded run and returns a dict of summary statistics. The formation error of
+    every tick and the distance traveled by every robot are also written to directory
+    (formation_error.npy, distance.npy).
+    """
+    meta, robots, balls = open_run(directory)
+    n = meta["n_robots"]
+    n_ticks = len(robots) // n
+    # each recorded tick lasts from the previous recorded time to its own
+    last_time = meta["start_time"]
+
+    durations = {}
+    distance = np.zeros(n)
+    last_xy = None
+    errors = np.lib.format.open_memmap(os.path.join(directory, "formation_error.npy"), mode="w+",
+                                       dtype=np.float64, shape=(n_ticks,))
+    error_sum = 0.
+    error_count = 0
+    error_max = np.nan
+    error_final = np.nan
+    degree_sum = 0.
+    degree_min = np.inf
+    connected_ticks = 0
+
+    for start in range(0, n_ticks, chunk_ticks):
+        block = np.asarray(robots[start * n:min(start + chunk_ticks, n_ticks) * n]).reshape(-1, n)
+        xy = np.stack([block["x"], block["y"]], axis=-1)
+
+        # a phase lasts from the tick where every robot has entered it to the tick where the last one leaves it
+        phase = block["state"].min(axis=1)
+        times = block["time"][:, 0]
+        periods = np.diff(times, prepend=last_time)
+        last_time = times[-1]
+        for value in np.unique(phase):
+            durations[int(value)] = durations.get(int(value), 0.) + periods[phase == value].sum()
+
+        steps = np.diff(xy if last_xy is None else np.concatenate([last_xy[None], xy]), axis=0)
+        distance += np.sqrt((steps ** 2).sum(axis=-1)).sum(axis=0)
+        last_xy = xy[-1]
+
+        chunk_errors = np.full(len(block), np.nan)
+        for value, formation in PHASE_FORMATIONS.items():
+            selected = phase == value
+            if selected.any() and len(FORMATION_SLOTS[formation]) == n:
+                chunk_errors[selected] = formation_error(xy[selected], formation, block["role"][selected])
+        errors[start:start + len(block)] = chunk_errors
+        valid = chunk_errors[~np.isnan(chunk_errors)]
+        if len(valid):
+            error_sum += valid.sum()
+            error_count += len(valid)
+            error_max = np.fmax(error_max, valid.max())
+            error_final = valid[-1]
+
+        degree = block["degree"]
+        degree_sum += degree.sum()
+        degree_min = min(degree_min, degree.min())
+        if n <= 64:
+            connected_ticks += _connected(block["neighbors"], n).sum()
+
+    errors.flush()
+    np.save(os.path.join(directory, "distance.npy"), distance)
+
+    summary = {"run": os.path.basename(os.path.normpath(directory)),
+               "ticks": n_ticks,
+               "sim_time": last_time - meta["start_time"],
+               "distance_mean": distance.mean(),
+               "distance_max": distance.max(),
+               "degree_mean": degree_sum / max(n_ticks * n, 1),
+               "degree_min": degree_min,
+               "connected_fraction": connected_ticks / float(n_ticks) if n <= 64 and n_ticks else np.nan}
+    for value in sorted(durations):
+        summary["phase_%d_duration" % value] = durations[value]
+
+    summary["formation_error_mean"] = error_sum / error_count if error_count else np.nan
+    summary["formation_error_max"] = error_max
+    summary["formation_error_final"] = error_final
+
+    summary.update(_ball_distances(meta, balls, chunk_ticks))
+    return summary
+
+
+def _ball_distances(meta, balls, chunk_ticks):
+    """
+    Closest and final distance of each ball to its nearest goal
+    """
+    n_balls = meta["n_balls"]
+    goals = np.array(meta["goals"])
+    if n_balls == 0 or len(balls) == 0 or len(goals) == 0:
+        return {}
+    n_ticks = len(balls) // n_balls
+    closest = np.full(n_balls, np.inf)
+    final = np.full(n_balls, np.nan)
+    for start in range(0, n_ticks, chunk_ticks):
+        block = np.asarray(balls[start * n_balls:min(start + chunk_ticks, n_ticks) * n_balls]).reshape(-1, n_balls)
+        xy = np.stack([block["x"], block["y"]], axis=-1)
+        to_goal = np.sqrt(((xy[:, :, None, :] - goals) ** 2).sum(axis=-1)).min(axis=-1)
+        closest = np.minimum(closest, to_goal.min(axis=0))
+        final = to_goal[-1]
+    result = {}
+    for b in range(n_balls):
+        result["ball%d_goal_closest" % b] = closest[b]
+        result["ball%d_goal_final" % b] = final[b]
+    return result
+
+
+def analyze_runs(directories, processes=None, chunk_ticks=20000):
+    """
+    Analyzes independent runs in parallel, returns their summaries in the same order
+    """
+    if processes == 1 or len(directories) <= 1:
+        return [analyze_run(d, chunk_ticks) for d in directories]
+    with multiprocessing.Pool(processes) as pool:
+        return pool.starmap(analyze_run, [(d, chunk_ticks) for d in directories])
+
+
+def write_summary(summaries, path):
+    """
+    Writes the summaries as a csv table, one line per run
+    """
+    columns = []
+    for summary in summaries:
+        columns += [c for c in summary if c not in columns]
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+        for summary in summaries:
+            writer.writerow(summary)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="analysis of recorded trajectory logs")
+    parser.add_argument("runs", nargs="+", help="directories written by TrajectoryRecorder")
+    parser.add_argument("--out", default="summary.csv")
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--chunk-ticks", type=int, default=20000, help="ticks loaded in memory at once")
+    args = parser.parse_args()
+
+    write_summary(analyze_runs(args.runs, args.processes, args.chunk_ticks), args.out)
@@ -0,0 +1,99 @@
+import json
+import os
+
+import numpy as np
+import pybullet as p
+
+# one record per robot per recorded tick. role is the formation slot held by the robot,
+# neighbors is a bitmask of the neighbor ids, only meaningful for swarms of at most 64 robots
+# (degree is always set)
+ROBOT_RECORD = np.dtype([("step", "<i8"), ("time", "<f8"), ("robot", "<i4"), ("state", "<i4"),
+                         ("x", "<f8"), ("y", "<f8"), ("yaw", "<f8"), ("role", "<i4"),
+                         ("degree", "<i4"), ("neighbors", "<u8")])
+
+# one record per ball per recorded tick
+BALL_RECORD = np.dtype([("step", "<i8"), ("time", "<f8"), ("ball", "<i4"), ("x", "<f8"), ("y", "<f8")])
+
+
+class TrajectoryRecorder():
+    """
+    Appends the trajectory of a World to flat binary files in directory:
+    robots.bin and balls.bin (arrays of ROBOT_RECORD / BALL_RECORD, readable with np.memmap)
+    and meta.json (swarm size, start time, goal positions, ...). Every record holds its simulated
+    time, the time step may change during the run (World(adaptive_step=True)).
+    Call record() after each world.stepSimulation(), only every `every` steps are written.
+    """
+    def __init__(self, world, directory, every=1):
+        self.world = world
+        self.every = every
+        self.steps = 0
+        n = len(world.robots)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        goals = []
+        for goal in world.goal_ids:
+            low, high = p.getAABB(goal, physicsClientId=world.physicsClient)
+            goals.append([(low[0] + high[0]) / 2., (low[1] + high[1]) / 2.])
+        meta = {"n_robots": n, "n_balls": len(world.balls), "start_time": world.time, "every": every, "goals": goals,
+                "robot_fields": list(ROBOT_RECORD.names)}
+        with open(os.path.join(directory, "meta.json"), "w") as f:
+            json.dump(meta, f, indent=1)
+
+        self.robot_file = open(os.path.join(directory, "robots.bin"), "wb")
+        self.ball_file = open(os.path.join(directory, "balls.bin"), "wb")
+        # records are filled in place and written every tick
+        self.robot_records = np.zeros(n, dtype=ROBOT_RECORD)
+        self.robot_records["robot"] = np.arange(n)
+        self.ball_records = np.zeros(len(world.balls), dtype=BALL_RECORD)
+        self.ball_records["ball"] = np.arange(len(world.balls))
+        self.bits = (np.uint64(1) << np.arange(min(n, 64), dtype=np.uint64))
+
+    def record(self):
+        self.steps += 1
+        if self.steps % self.every:
+            return
+        swarm = self.world.swarm
+        records = self.robot_records
+        records["step"] = self.steps
+        records["time"] = self.world.time
+        records["state"] = swarm.mission_state
+        records["x"] = swarm.pos[:, 0]
+        records["y"] = swarm.pos[:, 1]
+        records["yaw"] = swarm.yaw
+        records["role"] = swarm.role
+        records["degree"] = swarm.neighbors.sum(axis=1)
+        if swarm.n_robots <= 64:
+            records["neighbors"] = np.bitwise_or.reduce(np.where(swarm.neighbors, self.bits, np.uint64(0)), axis=1)
+        self.robot_file.write(records.tobytes())
+
+        balls = self.ball_records
+        balls["step"] = self.steps
+        balls["time"] = self.world.time
+        for i, ball in enumerate(self.world.balls):
+            pos, _ = p.getBasePositionAndOrientation(ball, physicsClientId=self.world.physicsClient)
+            balls["x"][i] = pos[0]
+            balls["y"][i] = pos[1]
+        self.ball_file.write(balls.tobytes())
+
+    def close(self):
+        self.robot_file.close()
+        self.ball_file.close()
+
+
+def open_run(directory):
+    """
+    Memory-maps a recorded run, returns (meta, robot records, ball records)
+    """
+    with open(os.path.join(directory, "meta.json")) as f:
+        meta = json.load(f)
+    if meta.get("robot_fields") != list(ROBOT_RECORD.names):
+        raise ValueError("%s was recorded with other robot record fields" % directory)
+    arrays = []
+    for name, dtype in (("robots.bin", ROBOT_RECORD), ("balls.bin", BALL_RECORD)):
+        path = os.path.join(directory, name)
+        if os.path.getsize(path) == 0:
+            arrays.append(np.zeros(0, dtype=dtype))
+        else:
+            arrays.append(np.memmap(path, dtype=dtype, mode="r"))
+    return meta, arrays[0], arrays[1]
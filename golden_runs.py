@@ -0,0 +1,175 @@
+# Deterministic regression harness: runs the square1 and circle234 missions headless for a
+# fixed number of steps and compares their trajectories against golden files, so that a
+# speed-up of the simulation or of the controllers can be shown not to change the behaviour.
+#
+#   python golden_runs.py --update               # (re)write golden/<mission>.npz
+#   python golden_runs.py                        # compare, bit for bit
+#   python golden_runs.py --tolerance 1e-6       # compare, allowing small numerical differences
+#
+# Each mission runs in its own subprocess, from its own folder (the missions use relative model
+# paths and import their own robot.py). Every step the poses of the robots and balls and the
+# mission states are folded into a running sha256. A golden file holds that hash every checkpoint
+# steps (the bit for bit comparison), the poses at those steps (the comparison within a tolerance)
+# and a short digest of every step, which locates the first step at which two runs differ.
+import argparse
+import hashlib
+import inspect
+import os
+import subprocess
+import sys
+import tempfile
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+GOLDEN_DIR = os.path.join(ROOT, "golden")
+
+# mission name -> folder, number of steps simulated
+MISSIONS = {
+    "square1": ("square1", 5000),
+    "circle234": ("circle234", 5000),
+}
+
+
+def _snapshot(world):
+    """
+    Returns the poses (x, y, z, quaternion) of the robots then the balls, and the mission states
+    """
+    import pybullet as p
+    bodies = [r.pybullet_id for r in world.robots] + [world.ball1, world.ball2]
+    client = getattr(world, "physicsClient", 0)
+    poses = np.array([sum(map(list, p.getBasePositionAndOrientation(b, physicsClientId=client)), []) for b in bodies])
+    states = np.array([getattr(r, "state", 0) for r in world.robots], dtype=np.int64)
+    return poses, states
+
+
+def record(steps, checkpoint):
+    """
+    Runs the mission of the current folder for steps steps, returns a dict of arrays:
+    - steps, hashes, poses, states: at every checkpoint, the running sha256 of all the steps so
+      far, the poses (bodies, 7) and the mission states
+    - digests: the first 8 bytes of the sha256 of each step alone
+    """
+    sys.path.insert(0, os.getcwd())
+    import pybullet as p
+    from swarm_simulation import World
+
+    if "gui" not in inspect.signature(World).parameters:
+        # Worlds older than the gui flag (e.g. the baseline) always connect with p.GUI
+        p.GUI = p.DIRECT
+        world = World()
+    else:
+        world = World(gui=False)
+    running = hashlib.sha256()
+    digests = np.zeros(steps, dtype=np.uint64)
+    checkpoints = {"steps": [], "hashes": [], "poses": [], "states": []}
+    for step in range(1, steps + 1):
+        world.stepSimulation()
+        poses, states = _snapshot(world)
+        data = poses.tobytes() + states.tobytes()
+        running.update(data)
+        digests[step - 1] = np.frombuffer(hashlib.sha256(data).digest()[:8], dtype=np.uint64)[0]
+        if step % checkpoint == 0 or step == steps:
+            checkpoints["steps"].append(step)
+            checkpoints["hashes"].append(running.hexdigest())
+            checkpoints["poses"].append(poses)
+            checkpoints["states"].append(states)
+    result = dict((key, np.array(values)) for key, values in checkpoints.items())
+    result["digests"] = digests
+    return result
+
+
+def run_mission(name, steps, checkpoint):
+    """
+    Runs a mission in a subprocess and returns its record, see record()
+    """
+    folder, _ = MISSIONS[name]
+    fd, out = tempfile.mkstemp(suffix=".npz")
+    os.close(fd)
+    try:
+        command = [sys.executable, os.path.abspath(__file__), "--child",
+                   "--steps", str(steps), "--checkpoint", str(checkpoint), "--out", out]
+        # the controllers print their progress, which is not part of the result
+        subprocess.run(command, cwd=os.path.join(ROOT, folder), check=True, stdout=subprocess.DEVNULL)
+        with np.load(out) as data:
+            return dict(data)
+    finally:
+        os.remove(out)
+
+
+def compare(golden, current, tolerance=0.):
+    """
+    Returns None when the runs match, else a description of the first divergence.
+    golden and current are records as returned by record(). With tolerance 0 the checkpoint
+    hashes must be equal, otherwise the poses at each checkpoint must match within tolerance
+    and the mission states exactly.
+    """
+    if not np.array_equal(golden["steps"], current["steps"]):
+        return "checkpoints at steps %s in the golden file, %s now" % (golden["steps"], current["steps"])
+    if golden["poses"].shape != current["poses"].shape:
+        return "recorded %s poses in the golden file, %s now" % (golden["poses"].shape[1:], current["poses"].shape[1:])
+    deviation = np.abs(golden["poses"] - current["poses"])
+    states_differ = (golden["states"] != current["states"]).any(axis=1)
+    if tolerance == 0.:
+        diverged = golden["hashes"] != current["hashes"]
+    else:
+        # NaN counts as a divergence
+        diverged = states_differ | ~(deviation <= tolerance).all(axis=(1, 2))
+    checkpoints = np.flatnonzero(diverged)
+    if len(checkpoints) == 0:
+        return None
+    c = checkpoints[0]
+    largest = np.nan_to_num(deviation[c], nan=np.inf).argmax()
+    body, column = np.unravel_index(largest, deviation[c].shape)
+    message = ("diverged by step %d: largest pose difference there %.3g (body %d, component %d)%s"
+               % (golden["steps"][c], deviation[c, body, column], body, column,
+                  ", mission states differ" if states_differ[c] else ""))
+    differ = np.flatnonzero(golden["digests"] != current["digests"])
+    if len(differ):
+        message += ", first step not bit for bit equal: %d" % (differ[0] + 1)
+    return message
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="deterministic runs of the missions compared to golden files")
+    parser.add_argument("missions", nargs="*", default=sorted(MISSIONS), help="missions to run")
+    parser.add_argument("--update", action="store_true", help="write the golden files instead of comparing")
+    parser.add_argument("--tolerance", type=float, default=0., help="0 for a bit for bit comparison")
+    parser.add_argument("--steps", type=int, default=None, help="steps to simulate (default: per mission)")
+    parser.add_argument("--checkpoint", type=int, default=250, help="steps between two checkpoints")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--out", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        np.savez(args.out, **record(args.steps, args.checkpoint))
+        sys.exit(0)
+
+    failed = False
+    for name in args.missions:
+        path = os.path.join(GOLDEN_DIR, name + ".npz")
+        if args.update:
+            steps = args.steps or MISSIONS[name][1]
+            golden = run_mission(name, steps, args.checkpoint)
+            if not os.path.isdir(GOLDEN_DIR):
+                os.makedirs(GOLDEN_DIR)
+            np.savez_compressed(path, **golden)
+            print("%s: golden file written (%d steps)" % (name, steps))
+            continue
+
+        if not os.path.exists(path):
+            print("%s: no golden file, run with --update first" % name)
+            failed = True
+            continue
+        with np.load(path) as data:
+            golden = dict(data)
+        steps = len(golden["digests"])
+        checkpoint = int(golden["steps"][0])
+        error = compare(golden, run_mission(name, steps, checkpoint), args.tolerance)
+        if error is None:
+            print("%s: ok (%d steps)" % (name, steps))
+        else:
+            print("%s: %s" % (name, error))
+            failed = True
+
+    sys.exit(1 if failed else 0)
@@ -5,9 +5,9 @@ import itertools
 from robot import Robot
     
 class World():
-    def __init__(self):
-        # create the physics simulator
-        self.physicsClient = p.connect(p.GUI)
+    def __init__(self, gui=True):
+        # create the physics simulator (headless with gui=False)
+        self.physicsClient = p.connect(p.GUI if gui else p.DIRECT)
         p.setGravity(0,0,-9.81)
         
         self.max_communication_distance = 2.0
@@ -0,0 +1,89 @@
+import os
+import sys
+import tracemalloc
+
+import pytest
+
+pytest.importorskip("pybullet")
+
+CIRCLE234 = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "circle234")
+sys.path.insert(0, CIRCLE234)
+
+# ticks run before measuring (the controllers start after 1 s), and ticks measured
+WARMUP_TICKS = 500
+MEASURED_TICKS = 500
+
+# memory a tick may allocate and free again, without the controllers: each broadcasting numpy
+# call uses a small scratch buffer and pybullet returns new tuples, arrays or containers
+# rebuilt every tick come on top of that
+TRANSIENT_BYTES = 4096
+
+OPTIONS = [{}, {"adaptive_step": True}, {"fidelity": "auto"}, {"command_deadband": 0.1}]
+OPTION_IDS = ["default", "adaptive_step", "fidelity_auto", "deadband"]
+
+
+def _world(options, monkeypatch):
+    # the models are loaded from paths relative to circle234
+    monkeypatch.chdir(CIRCLE234)
+    from swarm_simulation import World
+    return World(gui=False, **options)
+
+
+@pytest.fixture(params=OPTIONS, ids=OPTION_IDS)
+def world(request, monkeypatch):
+    world = _world(request.param, monkeypatch)
+    yield world
+    world.close()
+
+
+@pytest.fixture(params=OPTIONS, ids=OPTION_IDS)
+def world_without_controllers(request, monkeypatch):
+    world = _world(dict(request.param, run_controllers=False), monkeypatch)
+    yield world
+    world.close()
+
+
+def test_steady_state_stepping_does_not_grow_memory(world):
+    for _ in range(WARMUP_TICKS):
+        world.stepSimulation()
+        world.events.poll()
+
+    # the first measured ticks replace the objects alive before tracing started (last
+    # messages, counters, ...), only the memory still growing after them counts
+    tracemalloc.start()
+    try:
+        for _ in range(MEASURED_TICKS):
+            world.stepSimulation()
+            world.events.poll()
+        before, _ = tracemalloc.get_traced_memory()
+        for _ in range(MEASURED_TICKS):
+            world.stepSimulation()
+            world.events.poll()
+        after, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    assert (after - before) / MEASURED_TICKS < 1.
+
+
+def test_stepping_allocates_no_temporaries(world_without_controllers):
+    world = world_without_controllers
+    for _ in range(WARMUP_TICKS):
+        world.stepSimulation()
+        world.events.poll()
+
+    # largest amount of memory allocated during a tick above what was held before it
+    transient = 0
+    tracemalloc.start()
+    try:
+        for _ in range(MEASURED_TICKS):
+            before, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            world.stepSimulation()
+            world.events.poll()
+            _, peak = tracemalloc.get_traced_memory()
+            transient = max(transient, peak - before)
+    finally:
+        tracemalloc.stop()
+
+    assert transient < TRANSIENT_BYTES